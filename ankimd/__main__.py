@@ -8,6 +8,7 @@ import yaml
 from ankimd.config_parser import NewConfig
 from ankimd.run import run
 from ankimd.utils.helpers import setup_cli_parser, setup_root_logger
+from ankimd.watch import watch
 
 
 def main():
@@ -26,7 +27,17 @@ def main():
         logger.error(f"Error parsing config file: {err}")
         raise Exception(f"Error parsing config file: {err}") from err
 
-    run(new_config)
+    if args.command == "watch":
+        watch(
+            new_config,
+            io_workers=args.io_workers,
+            jobs=args.jobs,
+            overlap=args.overlap,
+            debounce=args.debounce,
+            poll_interval=args.poll,
+        )
+    else:
+        run(new_config, io_workers=args.io_workers, jobs=args.jobs, overlap=args.overlap)
 
 
 if __name__ == "__main__":
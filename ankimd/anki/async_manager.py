@@ -0,0 +1,60 @@
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from ankimd.anki.manager import AnkiManager
+from ankimd.media import Picture
+from ankimd.notes.note import Note
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncAnkiManager:
+    """
+    asyncio variant of AnkiManager.
+
+    Every request runs in a thread with the blocking AnkiManager, which keeps the pooled session, the chunking
+    of multi requests and the encoding of the payloads in one place. Awaiting them lets the scheduler overlap
+    requests of independent stages with each other and with the local work.
+    """
+
+    manager: AnkiManager
+
+    def __init__(self, manager: AnkiManager) -> None:
+        self.manager = manager
+
+    def close(self) -> None:
+        self.manager.close()
+
+    async def get_ids(self, note_ids: Optional[Set[int]] = None) -> Set[int]:
+        return await asyncio.to_thread(self.manager.get_ids, note_ids)
+
+    async def get_medias(self) -> Dict[str, Set[str]]:
+        return await asyncio.to_thread(self.manager.get_medias)
+
+    async def get_media_hashes(self, medias: List[Picture]) -> Dict[str, Optional[str]]:
+        return await asyncio.to_thread(self.manager.get_media_hashes, medias)
+
+    async def store_media_files(self, pictures: List[Picture]) -> None:
+        return await asyncio.to_thread(self.manager.store_media_files, pictures)
+
+    async def check_new_notes(self, notes: List[Note]) -> Optional[List[Dict[str, Any]]]:
+        return await asyncio.to_thread(self.manager.check_new_notes, notes)
+
+    async def adds_new_notes(self, notes: List[Note]) -> Optional[List[Tuple[Note, int]]]:
+        return await asyncio.to_thread(self.manager.adds_new_notes, notes)
+
+    async def updates_existing_notes(self, notes: List[Note]) -> None:
+        return await asyncio.to_thread(self.manager.updates_existing_notes, notes)
+
+    async def ensure_correct_deck(self, notes: List[Note]) -> None:
+        return await asyncio.to_thread(self.manager.ensure_correct_deck, notes)
+
+    async def get_notes_differing_from_anki(self, notes: List[Note]) -> List[Note]:
+        return await asyncio.to_thread(self.manager.get_notes_differing_from_anki, notes)
+
+    async def delete_notes(self, notes: List[Note]) -> None:
+        return await asyncio.to_thread(self.manager.delete_notes, notes)
+
+    async def create_decks(self, decks: List[str]) -> None:
+        return await asyncio.to_thread(self.manager.create_decks, decks)
@@ -0,0 +1,47 @@
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveChunker:
+    """
+    decides how many actions go in each chunk of a multi request.
+
+    A chunk never has more than max_actions actions or more than max_bytes of encoded json (unless a single
+    action is bigger than that, then it is sent alone). Between those bounds the number of actions per chunk
+    adapts to the time anki took to answer the previous chunks: it doubles while chunks are answered well under
+    target_seconds and halves when they take much longer.
+    """
+
+    max_actions: int
+    max_bytes: int
+    target_seconds: float
+    chunk_size: int
+
+    def __init__(self, max_actions: int, max_bytes: int, target_seconds: float, initial_size: int = 100):
+        self.max_actions = max(1, max_actions)
+        self.max_bytes = max_bytes
+        self.target_seconds = target_seconds
+        self.chunk_size = max(1, min(initial_size, self.max_actions))
+
+    def is_full(self, actions: int, size: int, next_action_size: int, max_bytes: Optional[int] = None) -> bool:
+        """whether the next action has to go in a new chunk, max_bytes overrides the default size budget"""
+        if actions == 0:
+            return False
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        return actions >= self.chunk_size or size + next_action_size > max_bytes
+
+    def record(self, actions: int, seconds: float) -> None:
+        """adapts the chunk size to the latency observed for a chunk of the given number of actions"""
+        if seconds > self.target_seconds * 1.5 and self.chunk_size > 1:
+            self.chunk_size = max(1, min(self.chunk_size, actions) // 2)
+            logger.debug(f"chunk of {actions} actions took {seconds:.2f}s, shrinking chunks to {self.chunk_size}")
+        elif (
+            seconds < self.target_seconds / 2
+            and actions >= self.chunk_size
+            and self.chunk_size < self.max_actions
+        ):
+            self.chunk_size = min(self.max_actions, self.chunk_size * 2)
+            logger.debug(f"chunk of {actions} actions took {seconds:.2f}s, growing chunks to {self.chunk_size}")
@@ -1,9 +1,13 @@
+import base64
+import io
 import json
 import logging
+import time
 from collections import defaultdict
-from typing import Dict, List, Set, Tuple, Any, Optional, Union
+from typing import Dict, Iterable, List, Set, Tuple, Any, Optional
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from ankimd.anki.requests import (
     AnkiGetMediaFilesNamesRequest,
@@ -17,11 +21,15 @@ from ankimd.anki.requests import (
     AnkiChangeDeckRequest,
     AnkiDeleteNotesRequest,
     AnkiCreateDeckRequest,
+    AnkiNotesInfoRequest,
+    AnkiGetDecksRequest,
 )
-from ankimd.anki.utils import _create_multi_request, _parse, T
+from ankimd.anki.chunker import AdaptiveChunker
+from ankimd.anki.utils import _chunks, _create_multi_request, _parse, T
 from ankimd.media import Picture
 from ankimd.notes.note import Note
 from ankimd.utils.constants import SUPPORTED_IMAGE_EXTS, SUPPORTED_AUDIO_EXTS
+from ankimd.utils.helpers import compute_hash
 
 logger = logging.getLogger(__name__)
 
@@ -31,69 +39,194 @@ class AnkiManager:
     This class will handle all the requests to anki
     """
 
-    def __init__(self, url: str) -> None:
+    def __init__(
+        self,
+        url: str,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 120.0,
+        pool_size: int = 4,
+        max_actions_per_request: int = 1000,
+        max_request_bytes: int = 16 * 1024 * 1024,
+        target_request_seconds: float = 2.0,
+        max_media_memory_bytes: int = 64 * 1024 * 1024,
+        upload_media_by_path: Optional[bool] = False,
+    ) -> None:
         self.url = url
+        self.max_media_memory_bytes = max_media_memory_bytes
+        # anki shares the filesystem with the vault, so it can read the media files itself,
+        # None when it is not known yet, then the first media uploaded tells, see _can_store_media_by_path
+        self.upload_media_by_path = upload_media_by_path
+        self.timeout = (connect_timeout, read_timeout)
+        self.chunker = AdaptiveChunker(
+            max_actions=max_actions_per_request,
+            max_bytes=max_request_bytes,
+            target_seconds=target_request_seconds,
+        )
+        # one session for the whole run, so the connection to anki is kept alive and reused between requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self) -> None:
+        self.session.close()
+
+    def __enter__(self) -> "AnkiManager":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
 
     def _invoke_request(self, request: T) -> Any:
         """Do the action with the specified parameters."""
+        # multi requests are split in chunks, each with its own response containing multiple results
+        if isinstance(request, AnkiMultiRequest):
+            return self._invoke_multi_request(request.requests)
         payload = json.dumps(request.to_anki_dict()).encode("utf-8")
-        response = requests.post(self.url, data=payload)
+        response = self.session.post(self.url, data=payload, timeout=self.timeout)
         logger.debug(
             f"sending a request to anki with the following payload: {payload} to the following url: {self.url}"
         )
-        # multi response will return a result list containing multiple results, we should parse them all
-        if isinstance(request, AnkiMultiRequest):
-            return [_parse(r) for r in _parse(response)]
         return _parse(response)
 
-    def get_ids(self) -> Set[int]:
-        """Get a set of the currently used card IDs."""
-        logger.info("Get a set of the currently used card IDs.")
-        requestJson = AnkiFindNotesRequest()
-        response = self._invoke_request(requestJson)
-        response = set(response)
+    def _invoke_multi_request(self, requests: Iterable[T], max_bytes: Optional[int] = None) -> List[Any]:
+        """
+        sends the requests as multi requests in chunks sized by the chunker, and returns the results of all the requests.
+        The requests are encoded one at a time and written straight into the payload of the chunk,
+        so only one chunk is held in memory, max_bytes caps the size budget of the chunks
+        """
+        results = []
+        payload = None
+        actions = 0
+        for request in requests:
+            action = json.dumps(request.to_anki_dict()).encode("utf-8")
+            if payload is not None and self.chunker.is_full(actions, payload.tell(), len(action), max_bytes):
+                results.extend(self._send_multi_chunk(payload, actions))
+                payload = None
+            if payload is None:
+                payload = io.BytesIO()
+                payload.write(b'{"action": "multi", "version": 6, "params": {"actions": [')
+                actions = 0
+            elif actions:
+                payload.write(b",")
+            payload.write(action)
+            actions += 1
+        if payload is not None:
+            results.extend(self._send_multi_chunk(payload, actions))
+        return results
+
+    def _send_multi_chunk(self, payload: io.BytesIO, actions: int) -> List[Any]:
+        payload.write(b"]}}")
+        logger.debug(f"sending a multi request with {actions} actions ({payload.tell()} bytes) to {self.url}")
+        payload.seek(0)
+        start = time.monotonic()
+        # the payload is streamed from the buffer, no copy of it is made
+        response = self.session.post(self.url, data=payload, timeout=self.timeout)
+        results = _parse(response)
+        self.chunker.record(actions, time.monotonic() - start)
+        # multi response will return a result list containing multiple results, we should parse them all
+        return [_parse(r) for r in results]
+
+    def get_ids(self, note_ids: Optional[Set[int]] = None, chunk_size: int = 500) -> Set[int]:
+        """
+        Get a set of the currently used note IDs.
+        When note_ids is given, only those are looked up with nid: queries in chunks, which returns the ones that exist,
+        otherwise every note ID of the collection is fetched
+        """
+        if note_ids is None:
+            logger.info("Get a set of the currently used card IDs.")
+            response = set(self._invoke_request(AnkiFindNotesRequest()))
+        else:
+            logger.info(f"Checking which of the {len(note_ids)} note IDs found in the changed files exist in anki")
+            response = set()
+            for chunk in _chunks(sorted(note_ids), chunk_size):
+                query = "nid:" + ",".join(str(note_id) for note_id in chunk)
+                response.update(self._invoke_request(AnkiFindNotesRequest(query)))
         logger.debug(f"found the following ids in anki: {response}")
         return response
 
-    def get_medias(self, fine_grained_search=False) -> Union[Dict[str, Dict[str, str]], Dict[str, Dict[str, Set[str]]]]:
-        """get a dictionary of the media files and their data stored in anki"""
+    def get_medias(self) -> Dict[str, Set[str]]:
+        """get the names of the media files stored in anki"""
         logger.info("getting all the media files stored in anki")
         media_file_names = self._invoke_request(AnkiGetMediaFilesNamesRequest())
-        if fine_grained_search:
-            media_file_multi_request = _create_multi_request(
-                media_file_names, AnkiRetrieveMediaFileRequest
-            )
-            result = self._invoke_request(media_file_multi_request)
-            result_dict = defaultdict(dict)
-            for filename, data in zip(media_file_names, result):
-                if filename.endswith(tuple(SUPPORTED_IMAGE_EXTS)):
-                    result_dict["images"][filename] = data
-                elif filename.endswith(tuple(SUPPORTED_AUDIO_EXTS)):
-                    result_dict["audios"][filename] = data
-            return result_dict
-        else:
-            result_dict = defaultdict(set)
-            for filename in media_file_names:
-                if filename.endswith(tuple(SUPPORTED_IMAGE_EXTS)):
-                    result_dict["images"].add(filename)
-                elif filename.endswith(tuple(SUPPORTED_AUDIO_EXTS)):
-                    result_dict["audios"].add(filename)
-            return result_dict
+        result_dict = defaultdict(set)
+        for filename in media_file_names:
+            if filename.endswith(tuple(SUPPORTED_IMAGE_EXTS)):
+                result_dict["images"].add(filename)
+            elif filename.endswith(tuple(SUPPORTED_AUDIO_EXTS)):
+                result_dict["audios"].add(filename)
+        return result_dict
 
+    def get_media_hashes(self, medias: List[Picture]) -> Dict[str, Optional[str]]:
+        """
+        downloads the given media files from anki and returns the sha256 of their content,
+        None for the files anki could not read.
+        The files are retrieved in chunks sized with the size of the local files, as their base64 content
+        is held in the response, and each chunk is reduced to hashes before the next one is retrieved,
+        so the media content held in memory stays within max_media_memory_bytes
+        """
+        if not medias:
+            return {}
+        logger.info(f"retrieving {len(medias)} media files from anki to compare them")
+        hashes = {}
+        chunk = []
+        chunk_size = 0
+        for media in sorted(medias, key=lambda media: media.filename):
+            # base64 takes 4 bytes for every 3 bytes of the file
+            media_size = media.get_size() * 4 // 3
+            if chunk and chunk_size + media_size > self.max_media_memory_bytes:
+                hashes.update(self._retrieve_media_hashes(chunk))
+                chunk = []
+                chunk_size = 0
+            chunk.append(media.filename)
+            chunk_size += media_size
+        if chunk:
+            hashes.update(self._retrieve_media_hashes(chunk))
+        return hashes
+
+    def _retrieve_media_hashes(self, filenames: List[str]) -> Dict[str, Optional[str]]:
+        result = self._invoke_multi_request(AnkiRetrieveMediaFileRequest(filename) for filename in filenames)
+        return {
+            filename: compute_hash(base64.b64decode(data)) if data else None
+            for filename, data in zip(filenames, result, strict=True)
+        }
 
     def store_media_files(self, pictures: List[Picture]) -> None:
         logger.info("storing media files in anki that are not already stored")
         if not pictures:
             return
-        requests = [AnkiStoreMediaFileRequest(pic) for pic in pictures]
-        multi_request = AnkiMultiRequest(requests)
-        response = self._invoke_request(multi_request)
+        if self.upload_media_by_path is None:
+            self.upload_media_by_path = self._can_store_media_by_path(pictures[0])
+            if self.upload_media_by_path:
+                pictures = pictures[1:]
+        # the medias are read and encoded one by one while the chunks are built, and each chunk is sent
+        # before the next one is encoded, so the encoded medias held in memory stay within max_media_memory_bytes
+        requests = (AnkiStoreMediaFileRequest(pic, by_path=self.upload_media_by_path) for pic in pictures)
+        max_bytes = min(self.chunker.max_bytes, self.max_media_memory_bytes)
+        response = self._invoke_multi_request(requests, max_bytes=max_bytes)
         logger.debug(f"stored the following media files in anki: {response}")
 
-    def check_new_notes(self, notes: List[Note]) -> Optional[List[Tuple[Note, int]]]:
+    def _can_store_media_by_path(self, picture: Picture) -> bool:
         """
-        here we don't need to use multi, there is already a route to add multiple notes
-        we need to return a list of ids of the notes that were added in the form of IDsFileLocation
+        stores the media by its path and reads it back, to know whether anki can read the files of the vault.
+        Anki may run on this machine and still not see the vault, like in a container with a mapped port
+        """
+        try:
+            self._invoke_request(AnkiStoreMediaFileRequest(picture, by_path=True))
+            data = self._invoke_request(AnkiRetrieveMediaFileRequest(picture.filename))
+        except Exception as err:
+            logger.info(f"anki can't read the medias from their path ({err}), uploading their content instead")
+            return False
+        if not data or compute_hash(base64.b64decode(data)) != picture.get_hash():
+            logger.info("anki can't read the medias from their path, uploading their content instead")
+            return False
+        logger.info("anki reads the medias from their path")
+        return True
+
+    def check_new_notes(self, notes: List[Note]) -> Optional[List[Dict[str, Any]]]:
+        """
+        here we don't need to use multi, there is already a route to check multiple notes
+        returns one result per note, like {"canAdd": false, "error": "cannot create note because it is a duplicate"}
         """
         if not notes:
             return
@@ -152,6 +285,43 @@ class AnkiManager:
         multi_request = _create_multi_request(notes, AnkiChangeDeckRequest)
         self._invoke_request(multi_request)
 
+    def get_notes_differing_from_anki(self, notes: List[Note], chunk_size: int = 500) -> List[Note]:
+        """
+        compares the notes with their current state in anki, fetched in chunks with notesInfo and getDecks,
+        and returns the ones whose fields, tags, model or deck differ, which are the only ones that need an update.
+        Reading is much cheaper for anki than updating, which goes through the undo and sync bookkeeping
+        """
+        if not notes:
+            return []
+        logger.info(f"comparing {len(notes)} notes with their state in anki")
+        differing_notes = []
+        for chunk in _chunks(notes, chunk_size):
+            notes_info = self._invoke_request(AnkiNotesInfoRequest(chunk))
+            cards = [card for info in notes_info for card in info.get("cards", [])]
+            card_decks = {}
+            if cards:
+                decks = self._invoke_request(AnkiGetDecksRequest(cards))
+                card_decks = {card: deck for deck, deck_cards in decks.items() for card in deck_cards}
+            for note, info in zip(chunk, notes_info, strict=True):
+                if self._differs_from_anki(note, info, card_decks):
+                    differing_notes.append(note)
+        logger.debug(f"{len(differing_notes)} of {len(notes)} notes differ from anki")
+        return differing_notes
+
+    @staticmethod
+    def _differs_from_anki(note: Note, info: Dict[str, Any], card_decks: Dict[int, str]) -> bool:
+        if not info:  # the note does not exist in anki
+            return True
+        if info["modelName"] != note.note_type.to_anki_dict():
+            return True
+        if {tag for tag in info["tags"] if tag} != {tag for tag in note.tags if tag}:
+            return True
+        anki_fields = info["fields"]
+        for name, value in note.get_rendered_fields().items():
+            if name not in anki_fields or anki_fields[name]["value"] != value:
+                return True
+        return any(card_decks.get(card) != note.target_deck for card in info["cards"])
+
     def delete_notes(self, notes: List[Note]) -> None:
         logger.info("deleting notes in anki")
         if not notes:
@@ -218,15 +218,27 @@ class AnkiStoreMediaFileRequest:
             "data": "SGVsbG8sIHdvcmxkIQ=="
         }
     }
+    with by_path, the absolute path of the file is sent instead of its data, and anki reads the file itself:
+    "params": {
+        "filename": "_hello.txt",
+        "path": "/path/to/file"
+    }
     """
 
-    def __init__(self, picture: Picture):
+    def __init__(self, picture: Picture, by_path: bool = False):
         self.action = "storeMediaFile"
         self.version = 6
-        self.params = {"filename": picture.filename, "data": picture.data}
+        self.picture = picture
+        self.by_path = by_path
 
     def to_anki_dict(self):
-        return self.__dict__
+        # the data is encoded only when the request is sent, see AnkiManager.store_media_files
+        params = {"filename": self.picture.filename}
+        if self.by_path:
+            params["path"] = str(self.picture.path.resolve())
+        else:
+            params["data"] = self.picture.get_data()
+        return {"action": self.action, "version": self.version, "params": params}
 
 
 class AnkiUpdateNoteRequest:
@@ -344,3 +356,47 @@ class AnkiCreateDeckRequest:
 
     def to_anki_dict(self):
         return self.__dict__
+
+
+class AnkiNotesInfoRequest:
+    """
+        ex:
+        {
+        "action": "notesInfo",
+        "version": 6,
+        "params": {
+            "notes": [1502298033753]
+        }
+    }
+    the result has the model name, tags, fields and cards of each note, or an empty object if the note does not exist
+    """
+
+    def __init__(self, notes: List[Note]):
+        self.action = "notesInfo"
+        self.version = 6
+        self.params = {"notes": [note.id for note in notes]}
+
+    def to_anki_dict(self):
+        return self.__dict__
+
+
+class AnkiGetDecksRequest:
+    """
+        ex:
+        {
+        "action": "getDecks",
+        "version": 6,
+        "params": {
+            "cards": [1502298036657, 1502298033753, 1502032366472]
+        }
+    }
+    the result maps each deck name to the ids of the given cards that are in it
+    """
+
+    def __init__(self, cards: List[int]):
+        self.action = "getDecks"
+        self.version = 6
+        self.params = {"cards": cards}
+
+    def to_anki_dict(self):
+        return self.__dict__
@@ -17,6 +17,11 @@ def _create_multi_request(list_of: List[T], request_type: Any) -> AnkiMultiReque
     return AnkiMultiRequest([request_type(object) for object in list_of])
 
 
+def _chunks(list_of: List[T], size: int) -> List[List[T]]:
+    """splits the list in consecutive lists of at most size elements"""
+    return [list_of[i : i + size] for i in range(0, len(list_of), size)]
+
+
 def _parse(response: Union[requests.Response, Dict]) -> Any:
     """Parse the received response by getting the object inside the result of a response."""
     if isinstance(response, requests.Response):
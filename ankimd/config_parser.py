@@ -1,6 +1,6 @@
 import logging
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Literal, Optional
 
 import os
 
@@ -10,7 +10,7 @@ logger = logging.getLogger(__name__)
 
 
 from typing_extensions import Annotated
-from pydantic import BaseModel, field_validator, ValidationInfo, Field
+from pydantic import BaseModel, field_validator, model_validator, ValidationInfo, Field, PrivateAttr
 
 
 class AnkiConfig(BaseModel):
@@ -18,6 +18,22 @@ class AnkiConfig(BaseModel):
     deck_name: Optional[str] = "Default"
     tags: Optional[List[str]] = []
     fine_grained_image_search: Optional[bool] = False
+    remote_diff: Optional[bool] = False  # compare notes without local fingerprints with their state in anki
+    connect_timeout: Optional[float] = 5.0  # seconds
+    read_timeout: Optional[float] = 120.0  # seconds
+    max_actions_per_request: Optional[int] = 1000  # upper bound of the actions batched in one multi request
+    max_request_mb: Optional[float] = 16  # upper bound of the size of one multi request
+    target_request_seconds: Optional[float] = 2.0  # the batches are resized to be answered in about this time
+    max_media_memory_mb: Optional[float] = 64  # upper bound of the encoded media held in memory while uploading
+    # data sends the content of the medias, path only their absolute path, which anki reads itself,
+    # auto uses path when anki manages to read the first uploaded media from its path
+    media_upload: Optional[Literal["data", "path", "auto"]] = "data"
+
+    def upload_media_by_path(self) -> Optional[bool]:
+        """None with auto, the anki manager finds out by uploading the first media by path"""
+        if self.media_upload == "auto":
+            return None
+        return self.media_upload == "path"
 
 
 class VaultConfig(BaseModel):
@@ -86,8 +102,20 @@ class NotetypeConfig(BaseModel):
     cloze: Optional[dict] = {}
     Obsidian: Optional[dict] = {}
     Altklausuren: Optional[dict] = {}
+    _note_types: Optional[List[NoteType]] = PrivateAttr(default=None)
+
+    @model_validator(mode="after")
+    def compile_note_types(self):
+        """builds the note types, and so compiles their regexes, once when the config is validated"""
+        self._note_types = self._build_note_types()
+        return self
 
     def get_note_types(self):
+        if self._note_types is None:
+            self._note_types = self._build_note_types()
+        return self._note_types
+
+    def _build_note_types(self):
         note_types = []
         if self.Basic:
             note_types.append(
@@ -143,6 +171,7 @@ class NewConfig(BaseModel):
     vault: VaultConfig
     notetypes: NotetypeConfig
     hashes_cache_dir: Annotated[str, Field(validate_default=True)] = ""
+    render_cache_size_mb: int = 64  # 0 disables the cache of the transformed fields
 
     def get_note_types(self):
         return self.notetypes.get_note_types()
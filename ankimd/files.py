@@ -1,15 +1,17 @@
-import hashlib
 import logging
 
 logger = logging.getLogger(__name__)
 import os
 import re
+from bisect import bisect_right
+from functools import cached_property
 from typing import List
 
-from ankimd.notes.note import Note
+from ankimd.manifest import FileStat
+from ankimd.notes.note import Note, NoteRecord
 
 import frontmatter
-from ankimd.utils.patterns import ID_REGEX_PATTERN, DELETE_REGEXES
+from ankimd.utils.patterns import DELETE_REGEXES, DELETE_REQUIRED_LITERALS, HEADING_REGEX
 from ankimd.utils.helpers import string_insert, overwrite_file_safely, compute_hash
 
 
@@ -29,6 +31,40 @@ class IDFileLocation:
         return f"\n<!--ID: {self.id}-->"
 
 
+class HeadingIndex:
+    """
+    The headings of a file sorted by position, each one with the hierarchy of headings it is nested in,
+    so the hierarchy at any position of the file is found with a binary search
+    """
+
+    positions: List[int]
+    hierarchies: List[List[str]]
+
+    def __init__(self, text: str):
+        self.positions = []
+        self.hierarchies = []
+        current_level_headings = {}
+        for match in HEADING_REGEX.finditer(text):
+            level = len(match.group(1))  # Number of '#' symbols indicates the level
+            current_level_headings[level] = match.group(2).strip()
+
+            # Remove deeper levels
+            for deeper_level in [lvl for lvl in current_level_headings if lvl > level]:
+                del current_level_headings[deeper_level]
+
+            self.positions.append(match.start())
+            self.hierarchies.append(
+                [current_level_headings[lvl] for lvl in sorted(current_level_headings)]
+            )
+
+    def get_hierarchy(self, position: int) -> List[str]:
+        """the hierarchy of the last heading that starts at or before the position"""
+        index = bisect_right(self.positions, position)
+        if index == 0:
+            return []
+        return list(self.hierarchies[index - 1])
+
+
 class FileNoteMetadata:
     target_deck: str
     vault_name: str
@@ -53,49 +89,85 @@ class File:
 
     file_name: str
     path: str
-    file_note_metadata: "FileNoteMetadata"
-    curr_file_content: str
+    vault_name: str
     content_len: int
-    original_file_content: str
-    line_numbers: int
     found_notes: List
     file_hash: str
-    tags: List[str]
-    target_deck: str
-    frontmatter: dict
     to_add_notes: List["Note"]
     original_hash: str
     curr_hash: str
+    stat: FileStat
 
-    def __init__(self, file_path, vault_path, vault_name):
+    def __init__(self, file_path, vault_path, vault_name, content=None):
+        """
+        the content can be given when the file was already read, as the worker processes that scan the files do
+        """
         self.path = file_path
         self.relative_path = os.path.relpath(self.path, vault_path)
         self.file_name = os.path.basename(self.path)
-        self.read_file()
-        self.original_hash = compute_hash(self.original_file_content.encode("utf-8"))
+        self.vault_name = vault_name
+        if content is None:
+            # stat before reading, so a write racing with the read is picked up by the next run
+            self.stat = FileStat.from_path(self.path)
+            self.read_file()
+        else:
+            self.stat = None
+            self.curr_file_content = content
+            self.content_len = len(content)
+        self.original_hash = compute_hash(self.curr_file_content.encode("utf-8"))
         self.curr_hash = self.original_hash
-        self.line_numbers = len(self.curr_file_content.split("\n"))
         self.found_notes = []
-        self.tags = self.get_tags()
-        self.target_deck = self.get_target_deck()
-        self.file_note_metadata = FileNoteMetadata(
-            target_deck=self.target_deck, vault_name=vault_name, tags=self.tags
-        )
         self.to_add_notes = []
 
     def read_file(self) -> None:
         """
-        this method will read the file content and store it in self.curr_file_content
+        this method will read the file content and store it in self.curr_file_content,
+        it is the only time the file is read, the frontmatter is parsed from this content when needed
         """
         logger.debug(f"reading file {self.path}")
         with open(self.path, "r", encoding="utf-8") as f:
-            self.original_file_content = f.read()
-        self.curr_file_content = self.original_file_content
-
-        post = frontmatter.load(self.path)
+            self.curr_file_content = f.read()
         self.content_len = len(self.curr_file_content)
-        metadata = post.metadata
-        self.frontmatter = {k.lower(): v for k, v in metadata.items()}
+
+    @property
+    def curr_file_content(self) -> str:
+        return self._curr_file_content
+
+    @curr_file_content.setter
+    def curr_file_content(self, content: str) -> None:
+        self._curr_file_content = content
+        self._heading_index = None  # it is rebuilt from the new content when needed
+
+    def get_heading_hierarchy(self, position: int) -> List[str]:
+        """
+        returns the headings the position of the content is nested in, from the top level down
+        """
+        if self._heading_index is None:
+            self._heading_index = HeadingIndex(self.curr_file_content)
+        return self._heading_index.get_hierarchy(position)
+
+    @cached_property
+    def frontmatter(self) -> dict:
+        """
+        the frontmatter is only parsed when the deck or the tags of the file are needed,
+        that is, when the file has notes
+        """
+        metadata, _ = frontmatter.parse(self.curr_file_content)
+        return {k.lower(): v for k, v in metadata.items()}
+
+    @cached_property
+    def tags(self) -> List[str]:
+        return self.get_tags()
+
+    @cached_property
+    def target_deck(self) -> str:
+        return self.get_target_deck()
+
+    @cached_property
+    def file_note_metadata(self) -> FileNoteMetadata:
+        return FileNoteMetadata(
+            target_deck=self.target_deck, vault_name=self.vault_name, tags=self.tags
+        )
 
     def get_tags(self) -> List[str]:
         """
@@ -131,10 +203,7 @@ class File:
         print("Scanning file", self.path)
 
         for note_type in note_types:
-            for regex in note_type.regexes:
-                full_regex = regex + ID_REGEX_PATTERN
-                regex = re.compile(full_regex, re.MULTILINE | re.UNICODE)  # | re.DEBUG for debugging
-
+            for regex in note_type.get_candidate_patterns(self.curr_file_content):
                 for match in regex.finditer(self.curr_file_content):
                     note = Note(
                         note_match=match,
@@ -145,7 +214,11 @@ class File:
                     )
                     self.found_notes.append(note)
 
-        for regex in DELETE_REGEXES:
+        has_deleted_notes = all(
+            literal in self.curr_file_content for literal in DELETE_REQUIRED_LITERALS
+        )
+        delete_regexes = DELETE_REGEXES if has_deleted_notes else []
+        for regex in delete_regexes:
             for match in regex.finditer(self.curr_file_content):
                 note = Note(
                     note_match=match,
@@ -160,17 +233,22 @@ class File:
         logger.debug(f"found {len(self.found_notes)} notes in file {self.path}")
         return self.found_notes
 
-    def append_to_add_notes(self, note: Note) -> None:
+    def set_found_notes_from_records(self, records: List[NoteRecord], note_types: List[any]) -> List["Note"]:
         """
-        this method will append a note to the list of notes to add
+        this method will rebuild the notes that a worker process found in the file
         """
-        self.to_add_notes.append(note)
+        self.found_notes = [
+            Note.from_record(record, source_file=self, note_types=note_types)
+            for record in records
+        ]
+        logger.debug(f"found {len(self.found_notes)} notes in file {self.path}")
+        return self.found_notes
 
-    def original_hash(self) -> str:
+    def append_to_add_notes(self, note: Note) -> None:
         """
-        this method will return the hash of the file
+        this method will append a note to the list of notes to add
         """
-        return hashlib.sha256(self.original_file_content.encode("utf-8")).hexdigest()
+        self.to_add_notes.append(note)
 
     def overwrite_content_with_new_ids(self, ids: List[IDFileLocation]) -> None:
         curr_text = self.curr_file_content
@@ -207,3 +285,4 @@ class File:
 
     def update_content(self):
         overwrite_file_safely(self.path, self.curr_file_content)
+        self.stat = FileStat.from_path(self.path)
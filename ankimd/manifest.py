@@ -0,0 +1,190 @@
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# version of the json files the state was kept in before the state store, also used by the media index
+MANIFEST_VERSION = 1
+
+
+class FileStat:
+    """
+    the part of os.stat that tells us if a file may have changed since the last run
+    """
+
+    size: int
+    mtime_ns: int
+    inode: int
+
+    def __init__(self, size, mtime_ns, inode):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.inode = inode
+
+    @classmethod
+    def from_path(cls, path) -> "FileStat":
+        st = os.stat(path)
+        return cls(st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def __eq__(self, other):
+        if not isinstance(other, FileStat):
+            return NotImplemented
+        return (self.size, self.mtime_ns, self.inode) == (
+            other.size,
+            other.mtime_ns,
+            other.inode,
+        )
+
+
+class ManifestEntry:
+    stat: FileStat
+    hash: str
+
+    def __init__(self, stat: FileStat, file_hash: str):
+        self.stat = stat
+        self.hash = file_hash
+
+    def to_list(self) -> list:
+        return [self.stat.size, self.stat.mtime_ns, self.stat.inode, self.hash]
+
+    @classmethod
+    def from_list(cls, values: list) -> "ManifestEntry":
+        size, mtime_ns, inode, file_hash = values
+        return cls(FileStat(size, mtime_ns, inode), file_hash)
+
+
+class FileManifest:
+    """
+    keeps track of the state of every file of the vault at the end of the last run, keyed by the path relative to the vault
+
+    a file whose stat (size, mtime_ns, inode) did not change since the last run is not opened at all,
+    a file whose stat changed is read and hashed, and only if the hash changed its notes are scanned again.
+
+    the manifest is persisted in the state store, which only writes the entries that changed or were removed.
+    The old flat list of hashes is used when there is no entry yet, so that upgrading does not trigger
+    a full rescan of the vault.
+    """
+
+    entries: Dict[str, ManifestEntry]
+    legacy_hashes: Set[str]
+    changed: Set[str]
+    removed: Set[str]
+
+    def __init__(self, entries: Optional[Dict[str, ManifestEntry]] = None, legacy_hashes: Optional[Iterable[str]] = None):
+        self.entries = entries or {}
+        self.legacy_hashes = set(legacy_hashes or [])
+        self.changed = set()
+        self.removed = set()
+
+    @staticmethod
+    def normalize(relative_path) -> str:
+        return Path(relative_path).as_posix()
+
+    def is_empty(self) -> bool:
+        return not self.entries and not self.legacy_hashes
+
+    def is_unchanged(self, relative_path, stat: FileStat) -> bool:
+        """the file can be skipped without opening it"""
+        entry = self.entries.get(self.normalize(relative_path))
+        return entry is not None and entry.stat == stat
+
+    def has_hash(self, relative_path, file_hash: str) -> bool:
+        """the file was touched, but its content is the same as in the last run"""
+        entry = self.entries.get(self.normalize(relative_path))
+        if entry is not None:
+            return entry.hash == file_hash
+        return file_hash in self.legacy_hashes
+
+    def set(self, relative_path, stat: FileStat, file_hash: str) -> None:
+        relative_path = self.normalize(relative_path)
+        self.entries[relative_path] = ManifestEntry(stat, file_hash)
+        self.changed.add(relative_path)
+        self.removed.discard(relative_path)
+
+    def retain(self, relative_paths: Iterable) -> None:
+        """drops the entries of files that are no longer in the vault"""
+        keep = {self.normalize(relative_path) for relative_path in relative_paths}
+        for relative_path in list(self.entries):
+            if relative_path not in keep:
+                del self.entries[relative_path]
+                self.changed.discard(relative_path)
+                self.removed.add(relative_path)
+
+
+class NoteFingerprints:
+    """
+    keeps the fingerprint of every note as it was last sent to anki, keyed by the note id,
+    with the file of the note and its offset in the file.
+
+    The fingerprint covers the rendered fields, the tags, the deck and the model of the note,
+    so an existing note whose fingerprint did not change does not need to be updated in anki.
+    """
+
+    fingerprints: Dict[int, str]
+    locations: Dict[int, Tuple[Optional[str], Optional[int]]]
+    changed: Set[int]
+    removed: Set[int]
+
+    def __init__(self):
+        self.fingerprints = {}
+        self.locations = {}
+        self.changed = set()
+        self.removed = set()
+
+    def get(self, note_id: int) -> Optional[str]:
+        return self.fingerprints.get(note_id)
+
+    def has_changed(self, note) -> bool:
+        """an unknown note counts as changed"""
+        return self.get(note.id) != note.get_fingerprint()
+
+    def update(self, notes: Iterable) -> None:
+        for note in notes:
+            if note.id is not None:
+                self.fingerprints[note.id] = note.get_fingerprint()
+                self.locations[note.id] = (
+                    FileManifest.normalize(note.source_file.relative_path),
+                    note.note_start_span,
+                )
+                self.changed.add(note.id)
+                self.removed.discard(note.id)
+
+    def remove(self, notes: Iterable) -> None:
+        for note in notes:
+            if note.id is None:
+                continue
+            self.fingerprints.pop(note.id, None)
+            self.locations.pop(note.id, None)
+            self.changed.discard(note.id)
+            self.removed.add(note.id)
+
+
+class MediaManifest:
+    """
+    keeps the size and sha256 of every media file uploaded to anki, or found to be identical in anki, keyed by its filename,
+    with the time it was uploaded or verified.
+
+    In the fine grained mode a media whose local size and hash match the manifest is known to be stored in anki,
+    so its content is only downloaded from anki to be compared when it is missing from the manifest or changed locally.
+    """
+
+    entries: Dict[str, Tuple[int, str, float]]
+    changed: Set[str]
+
+    def __init__(self):
+        self.entries = {}
+        self.changed = set()
+
+    def matches(self, media) -> bool:
+        """the media was uploaded with the same content it has now"""
+        entry = self.entries.get(media.filename)
+        return entry is not None and entry[0] == media.get_size() and entry[1] == media.get_hash()
+
+    def update(self, medias: Iterable) -> None:
+        now = time.time()
+        for media in medias:
+            self.entries[media.filename] = (media.get_size(), media.get_hash(), now)
+            self.changed.add(media.filename)
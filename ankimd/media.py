@@ -1,13 +1,20 @@
 import enum
+import unicodedata
 from pathlib import Path
+from typing import Optional
 
-from ankimd.utils.helpers import file_encode
+from ankimd.utils.helpers import file_encode, file_hash
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+def normalize_media_filename(filename: str) -> str:
+    """the same file can be referenced with differently composed unicode names, anki stores them in NFC"""
+    return unicodedata.normalize("NFC", filename)
+
+
 class MediaState(enum.Enum):
     STORED = enum.auto()
     UNKNOWN = enum.auto()
@@ -15,38 +22,80 @@ class MediaState(enum.Enum):
 
 
 class Picture:
-    data: str
+    path: Path
     filename: str
+    link_path: Optional[str]
     state: MediaState
+    hash: Optional[str]
 
-    def __init__(self, filename):
+    def __init__(self, filename, link_path=None):
         self.filename = filename
+        # the path given in the link to the media, if any, used to pick between medias with the same name
+        self.link_path = link_path
         self.state = MediaState.UNKNOWN
+        self.hash = None
 
     def to_anki_dict(self):
-        return {"filename": self.filename, "data": self.data}
+        return {"filename": self.filename, "data": self.get_data()}
 
     def set_state(self, state):
         self.state = state
 
-    def load_data(self, dir: Path):
-        self.data = file_encode(dir / self.filename)
+    def load_data(self, path: Path):
+        """
+        sets the file of the media, found with the media index. The data is only read and encoded by get_data,
+        right before it is needed, so the encoded data of all the medias is never held in memory at the same time
+        """
+        self.path = path
+
+    def get_data(self) -> str:
+        return file_encode(self.path)
+
+    def get_size(self) -> int:
+        return self.path.stat().st_size
+
+    def get_hash(self) -> str:
+        # the hash is needed both to categorize the media and to record it in the media manifest
+        if self.hash is None:
+            self.hash = file_hash(self.path)
+        return self.hash
 
 
 class Audio:
-    data: str
+    path: Path
     filename: str
+    link_path: Optional[str]
     state: MediaState
+    hash: Optional[str]
 
-    def __init__(self, filename):
+    def __init__(self, filename, link_path=None):
         self.filename = filename
+        # the path given in the link to the media, if any, used to pick between medias with the same name
+        self.link_path = link_path
         self.state = MediaState.UNKNOWN
+        self.hash = None
 
     def to_anki_dict(self):
-        return {"filename": self.filename, "data": self.data}
+        return {"filename": self.filename, "data": self.get_data()}
 
     def set_state(self, state):
         self.state = state
 
-    def load_data(self, dir: Path):
-        self.data = file_encode(dir / self.filename)
+    def load_data(self, path: Path):
+        """
+        sets the file of the media, found with the media index. The data is only read and encoded by get_data,
+        right before it is needed, so the encoded data of all the medias is never held in memory at the same time
+        """
+        self.path = path
+
+    def get_data(self) -> str:
+        return file_encode(self.path)
+
+    def get_size(self) -> int:
+        return self.path.stat().st_size
+
+    def get_hash(self) -> str:
+        # the hash is needed both to categorize the media and to record it in the media manifest
+        if self.hash is None:
+            self.hash = file_hash(self.path)
+        return self.hash
@@ -0,0 +1,112 @@
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+from ankimd.media import normalize_media_filename
+from ankimd.utils.constants import SUPPORTED_AUDIO_EXTS, SUPPORTED_IMAGE_EXTS
+
+logger = logging.getLogger(__name__)
+
+MEDIA_EXTS = tuple(f".{ext}" for ext in SUPPORTED_IMAGE_EXTS + SUPPORTED_AUDIO_EXTS)
+
+
+class MediaIndex:
+    """
+    maps the filename of every media of the vault, case insensitively, to the absolute paths where it is found.
+
+    Every directory is stored with its mtime, its media files (with their size and mtime) and its subdirectories.
+    A file created, deleted or renamed changes the mtime of its directory, so on the next scan only the directories
+    whose mtime changed are listed again, the others cost one stat.
+    The directories are kept in the state store, which only writes the ones listed again or removed since it was saved.
+
+    The medias directory of the config is scanned first, and its files are preferred when a filename
+    is found in several places, unless the link to the media gives its path.
+    """
+
+    roots: List[Path]
+    dirs: Dict[str, dict]
+    by_name: Dict[str, List[str]]
+    changed: Set[str]
+    removed: Set[str]
+
+    def __init__(self, roots: Iterable[Path], dirs: Optional[Dict[str, dict]] = None):
+        self.roots = []
+        for root in roots:
+            root = Path(root).resolve()
+            if root not in self.roots:
+                self.roots.append(root)
+        self.dirs = dirs or {}
+        self.by_name = {}
+        # the directories listed again and removed since the index was saved
+        self.changed = set()
+        self.removed = set()
+
+    @staticmethod
+    def key(filename: str) -> str:
+        return normalize_media_filename(filename).lower()
+
+    def scan(self, exclude_dirs: Optional[List[str]] = None, exclude_dotted_dirs: bool = True) -> None:
+        """walks the roots again, listing only the directories that changed since the last scan"""
+        exclude_dirs = set(exclude_dirs or [])
+        previous_dirs = self.dirs
+        self.dirs = {}
+        listed = 0
+        stack = list(reversed(self.roots))
+        while stack:
+            dir_path = stack.pop()
+            key = str(dir_path)
+            if key in self.dirs:  # a root inside another root
+                continue
+            try:
+                mtime_ns = os.stat(dir_path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            entry = previous_dirs.get(key)
+            if entry is None or entry["mtime_ns"] != mtime_ns:
+                entry = self._list_dir(dir_path, mtime_ns)
+                listed += 1
+                self.changed.add(key)
+                self.removed.discard(key)
+            self.dirs[key] = entry
+            for name in reversed(entry["dirs"]):
+                if name in exclude_dirs or (exclude_dotted_dirs and name.startswith(".")):
+                    continue
+                stack.append(dir_path / name)
+        removed = previous_dirs.keys() - self.dirs.keys()
+        self.removed.update(removed)
+        self.changed.difference_update(removed)
+        logger.info(f"media index: listed {listed} of {len(self.dirs)} directories")
+        self._build_names()
+
+    @staticmethod
+    def _list_dir(dir_path: Path, mtime_ns: int) -> dict:
+        files = {}
+        subdirs = []
+        with os.scandir(dir_path) as entries:
+            for dir_entry in entries:
+                if dir_entry.is_dir():
+                    subdirs.append(dir_entry.name)
+                elif dir_entry.name.lower().endswith(MEDIA_EXTS) and dir_entry.is_file():
+                    st = dir_entry.stat()
+                    files[dir_entry.name] = [st.st_size, st.st_mtime_ns]
+        return {"mtime_ns": mtime_ns, "files": files, "dirs": sorted(subdirs)}
+
+    def _build_names(self) -> None:
+        self.by_name = {}
+        for dir_key, entry in self.dirs.items():
+            for name in entry["files"]:
+                self.by_name.setdefault(self.key(name), []).append(os.path.join(dir_key, name))
+
+    def resolve(self, filename: str, link_path: Optional[str] = None) -> Optional[Path]:
+        """the absolute path of the media, or None when it is not in the vault"""
+        candidates = self.by_name.get(self.key(filename))
+        if not candidates:
+            return None
+        if link_path:
+            wanted = "/" + self.key(link_path.replace("\\", "/").lstrip("./") + filename)
+            for candidate in candidates:
+                if self.key(Path(candidate).as_posix()).endswith(wanted):
+                    return Path(candidate)
+        # the order of the candidates follows the order of the roots, so the medias directory comes first
+        return Path(candidates[0])
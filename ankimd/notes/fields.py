@@ -1,5 +1,5 @@
 from functools import partial
-from typing import Protocol, List, Any
+from typing import Protocol, List, Any, Optional
 import re
 
 from ankimd.notes.transformers.fields import (
@@ -12,6 +12,7 @@ from ankimd.notes.transformers.fields import (
     remove_blockquote
 )
 from ankimd.notes.transformers.utils import create_link
+from ankimd.notes.render_cache import cached_transform
 
 
 class NoteField(Protocol):
@@ -31,6 +32,7 @@ class NoteField(Protocol):
 
 class FrontField:
     text: str
+    rendered_text: Optional[str]
     vault_name: str
     source_file_name: str
 
@@ -40,6 +42,10 @@ class FrontField:
         else:
             self.field_name = field_name
         self.text = text
+        # the transformed text, kept apart from the raw text so rendering the field twice gives the same result
+        self.rendered_text = None
+        self.vault_name = vault_name
+        self.source_file_name = source_file_name
         url_link_to_file = create_link(
             vault_name=vault_name,
             file_name=source_file_name,
@@ -64,19 +70,35 @@ class FrontField:
         ]
 
     def transform(self):
-        for transformer in self.transformers:
-            self.text = transformer(self.text)
+        if self.rendered_text is not None:
+            return self
+        # the link to the source file is part of the output, so the file name is part of the cache key
+        self.rendered_text = cached_transform(
+            self.text,
+            self.apply_transformers,
+            type(self).__name__,
+            self.vault_name,
+            self.source_file_name,
+        )
         return self
 
+    def apply_transformers(self, text):
+        for transformer in self.transformers:
+            text = transformer(text)
+        return text
+
     def get_field_name(self):
         return self.field_name
 
     def get_field_value(self):
-        return self.text
+        # the fields are transformed lazily, the first time their value is needed
+        self.transform()
+        return self.rendered_text
 
 
 class BackField:
     text: str
+    rendered_text: Optional[str]
     vault_name: str
 
     def __init__(self, text, vault_name, field_name=None):
@@ -85,6 +107,8 @@ class BackField:
         else:
             self.field_name = field_name
         self.text = text
+        self.rendered_text = None
+        self.vault_name = vault_name
 
         links_creator_transformer = partial(replace_with_link, vault_name=vault_name)
 
@@ -97,18 +121,29 @@ class BackField:
         ]
 
     def transform(self):
-        for transformer in self.transformers:
-            self.text = transformer(self.text)
+        if self.rendered_text is not None:
+            return self
+        self.rendered_text = cached_transform(
+            self.text, self.apply_transformers, type(self).__name__, self.vault_name
+        )
         return self
 
+    def apply_transformers(self, text):
+        for transformer in self.transformers:
+            text = transformer(text)
+        return text
+
     def get_field_name(self):
         return self.field_name
 
     def get_field_value(self):
-        return self.text
+        # the fields are transformed lazily, the first time their value is needed
+        self.transform()
+        return self.rendered_text
     
 class CustomField:
     text: str
+    rendered_text: Optional[str]
     vault_name: str
 
     def __init__(self, text, vault_name, field_name=None):
@@ -117,6 +152,8 @@ class CustomField:
         else:
             self.field_name = field_name
         self.text = text
+        self.rendered_text = None
+        self.vault_name = vault_name
 
         links_creator_transformer = partial(replace_with_link, vault_name=vault_name)
 
@@ -131,15 +168,25 @@ class CustomField:
         ]
 
     def transform(self):
-        for transformer in self.transformers:
-            self.text = transformer(self.text)
+        if self.rendered_text is not None:
+            return self
+        self.rendered_text = cached_transform(
+            self.text, self.apply_transformers, type(self).__name__, self.vault_name
+        )
         return self
 
+    def apply_transformers(self, text):
+        for transformer in self.transformers:
+            text = transformer(text)
+        return text
+
     def get_field_name(self):
         return self.field_name
 
     def get_field_value(self):
-        return self.text
+        # the fields are transformed lazily, the first time their value is needed
+        self.transform()
+        return self.rendered_text
     
 class ContextField: 
 
@@ -184,4 +231,25 @@ class LinkField:
         return self.field_name
 
     def get_field_value(self):
-        return self.text
\ No newline at end of file
+        return self.text
+
+
+class RenderedField:
+    """
+    a field whose text was already transformed, for example by a worker process
+    """
+
+    text: str
+
+    def __init__(self, field_name, text):
+        self.field_name = field_name
+        self.text = text
+
+    def transform(self):
+        pass
+
+    def get_field_name(self):
+        return self.field_name
+
+    def get_field_value(self):
+        return self.text
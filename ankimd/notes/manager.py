@@ -1,8 +1,9 @@
-from pathlib import Path
-from typing import List, Set, Dict, Tuple, Any, Union
+from typing import Iterable, List, Set, Dict, Tuple, Any, Optional
 
 from ankimd.files import File
-from ankimd.media import MediaState, Picture, Audio
+from ankimd.manifest import MediaManifest
+from ankimd.media_index import MediaIndex
+from ankimd.media import MediaState, Picture, Audio, normalize_media_filename
 from ankimd.notes.note import Note, State
 
 import logging
@@ -20,7 +21,7 @@ class NotesManager:
     notes_to_edit: List[Note]
     notes_to_delete: List[Note]
     new_medias: List[Any]
-    medias: List[Picture]
+    medias: Dict[str, Picture]
 
     def __init__(self, notes) -> None:
         self.notes: List[Note] = notes
@@ -29,7 +30,11 @@ class NotesManager:
         self.notes_to_delete: List[Note] = list()
         self.new_medias: List[Picture] = list()
         self.new_audios: List[Audio] = list()
-        self.medias: List[Any] = [picture for note in notes for picture in note.medias]
+        # a media embedded in many notes is registered once, so it is loaded, compared and uploaded once
+        self.medias: Dict[str, Any] = {}
+        for note in notes:
+            for media in note.medias:
+                self.medias.setdefault(normalize_media_filename(media.filename), media)
 
     def parse_note_to_add(self, note: Note) -> None:
         self.notes_to_add.append(note)
@@ -52,6 +57,10 @@ class NotesManager:
     def get_all_notes_to_delete(self) -> List[Note]:
         return self.notes_to_delete
 
+    def get_referenced_ids(self) -> Set[int]:
+        """the IDs found in the files that may or may not exist in anki"""
+        return {note.id for note in self.notes if note.state == State.UNKNOWN}
+
     def categorize_notes(self, existent_ids: Set[int]) -> None:
         """
         2 side effects outside the scope of the class:
@@ -83,36 +92,57 @@ class NotesManager:
         for note in self.notes_to_add:
             note.source_file.append_to_add_notes(note)
 
-    def categorize_medias(self, pictures_in_anki: Union[Dict[str, str], Set[str]],
-                              audios_in_anki: Union[Dict[str, str], Set[str]]) -> None:
+    def categorize_medias(self, pictures_in_anki: Set[str], audios_in_anki: Set[str],
+                              media_manifest: Optional[MediaManifest] = None) -> None:
+        """
+        a media is new when there is no media with its name in anki.
+        When a media manifest is given (the fine grained mode), a media with its name in anki is only stored
+        if its content matches the manifest, the others stay UNKNOWN until categorize_verified_medias
+        compares them with the content in anki
+        """
+        medias_in_anki = {normalize_media_filename(filename) for filename in pictures_in_anki.union(audios_in_anki)}
+        for name, media in self.medias.items():
+            if name not in medias_in_anki:
+                media.set_state(MediaState.NEW)
+                self.new_medias.append(media)
+            elif media_manifest is None or media_manifest.matches(media):
+                media.set_state(MediaState.STORED)
+
+    def get_medias_to_verify(self) -> List[Picture]:
+        return [media for media in self.medias.values() if media.state == MediaState.UNKNOWN]
+
+    def categorize_verified_medias(self, hashes_in_anki: Dict[str, Optional[str]]) -> List[Picture]:
+        """
+        categorizes the medias that were not in the media manifest, given the sha256 of their content in anki,
+        and returns the ones that are already stored
+        """
+        stored_medias = []
+        for media in self.get_medias_to_verify():
+            if hashes_in_anki.get(media.filename) == media.get_hash():
+                media.set_state(MediaState.STORED)
+                stored_medias.append(media)
+            else:
+                media.set_state(MediaState.NEW)
+                self.new_medias.append(media)
+        return stored_medias
+
+    def load_media_data(self, media_index: MediaIndex, medias: Optional[Iterable[Picture]] = None) -> List[Picture]:
         """
-        analyzes the name of the medias as well as the content of the picture to determine if it is new or not
+        locates the given medias with the media index, all the medias by default, and returns the ones found.
+        A media that is not in the vault is dropped with a warning instead of failing the sync
         """
-        # if pictures_in_anki and audios_in_anki are a set, it means that the user has chosen to not compare the content of the media
-        if isinstance(pictures_in_anki, set) and isinstance(audios_in_anki, set):
-            medias_in_anki = pictures_in_anki.union(audios_in_anki)
-            for media in self.medias:
-                if media.filename in medias_in_anki:
-                    media.set_state(MediaState.STORED)
-                else:
-                    media.set_state(MediaState.NEW)
-                    self.new_medias.append(media)
-        else:
-            medias_in_anki = {**pictures_in_anki, **audios_in_anki}
-            for media in self.medias:
-                if (
-                    media.filename in medias_in_anki
-                    and media.data == medias_in_anki[media.filename]
-                ):
-                    media.set_state(MediaState.STORED)
-                else:
-                    media.set_state(MediaState.NEW)
-                    self.new_medias.append(media)
-
-    def load_media_data(self, path_to_directory: Path) -> None:
-        """ """
-        for media in self.medias:
-            media.load_data(Path(path_to_directory))
+        if medias is None:
+            medias = list(self.medias.values())
+        found_medias = []
+        for media in medias:
+            path = media_index.resolve(media.filename, media.link_path)
+            if path is None:
+                logger.warning(f"media file {media.filename} was not found in the vault, it will not be sent to anki")
+                self.medias.pop(normalize_media_filename(media.filename), None)
+                continue
+            media.load_data(path)
+            found_medias.append(media)
+        return found_medias
 
     def get_media_to_add(self) -> List[Picture]:
         return self.new_medias
@@ -1,4 +1,5 @@
 import enum
+import json
 import re
 from typing import List, Optional, Any
 
@@ -9,14 +10,16 @@ from ankimd.notes.fields import (
     CustomField,
     ContextField,
     LinkField,
+    RenderedField,
 )
 
 from ankimd.media import Picture, Audio
-from ankimd.utils.helpers import convert_listDicts_to_dict
+from ankimd.utils.helpers import compute_hash, convert_listDicts_to_dict, get_required_literals
 from ankimd.utils.patterns import (
     IMAGE_FILE_WIKILINK_REGEX,
     AUDIO_FILE_REGEX,
     IMAGE_FILE_MARKDOWN_REGEX,
+    ID_REGEX_PATTERN,
 )
 
 from urllib.parse import unquote
@@ -55,6 +58,7 @@ class Note:
     target_deck: str
     tags: List[str]
     fields: List[NoteField]  # implements the interface of NoteField
+    rendered_fields: Optional[dict]
     medias: List[Any]
     to_delete: bool
     options: NoteOptions
@@ -92,10 +96,40 @@ class Note:
         self.audios = list()
         self.find_medias()
         self.create_fields()
+        self.rendered_fields = None
         self.set_id_location_in_file()
 
         self.options = NoteOptions()
 
+    @classmethod
+    def from_record(cls, record: "NoteRecord", source_file, note_types) -> "Note":
+        """
+        rebuilds a note scanned in a worker process, the fields are already transformed
+        """
+        note = cls.__new__(cls)
+        if record.note_type_index is None:
+            note.note_type = None
+        else:
+            note.note_type = note_types[record.note_type_index]
+        note.note_match = None
+        note.file_note_metadata = source_file.file_note_metadata
+        note.original_note_text = record.original_note_text
+        note.state = record.state
+        note.id = record.id
+        note.source_file = source_file
+        note.note_start_span = record.note_start_span
+        note.note_end_span = record.note_end_span
+        note.curr_note_text = note.original_note_text
+        note.target_deck = record.target_deck
+        note.tags = record.tags
+        note.medias = record.medias
+        note.audios = list()
+        note.fields = [RenderedField(name, value) for name, value in record.fields]
+        note.rendered_fields = None
+        note.id_location_in_file = record.id_location_in_file
+        note.options = NoteOptions()
+        return note
+
     def convert_tags(self, tags):
         converted_tags = []
         for tag in tags:
@@ -144,17 +178,18 @@ class Note:
     def find_medias(self):
         for match in IMAGE_FILE_WIKILINK_REGEX.finditer(self.original_note_text):
             full_file_name = f"{match.group('filename')}.{match.group('extension')}"
-            pic = Picture(filename=full_file_name)
+            pic = Picture(filename=full_file_name, link_path=match.group("path"))
             self.medias.append(pic)
         for match in IMAGE_FILE_MARKDOWN_REGEX.finditer(self.original_note_text):
             full_file_name = unquote(
                 f"{match.group('filename')}.{match.group('extension')}"
             )
-            pic = Picture(filename=full_file_name)
+            link_path = unquote(match.group("path")) if match.group("path") else None
+            pic = Picture(filename=full_file_name, link_path=link_path)
             self.medias.append(pic)
         for match in AUDIO_FILE_REGEX.finditer(self.original_note_text):
             full_file_name = f"{match.group('filename')}.{match.group('extension')}"
-            audio = Audio(filename=full_file_name)
+            audio = Audio(filename=full_file_name, link_path=match.group("path"))
             self.medias.append(audio)
 
     def set_state(self, state):
@@ -163,7 +198,7 @@ class Note:
     def create_fields(self):
 
         if self.note_type == None:
-            fields = []
+            self.fields = []
             return
 
         if (
@@ -204,8 +239,7 @@ class Note:
                     self.fields.append(field)
                 elif value == "CONTEXT":
                     relative_path = self.source_file.relative_path
-                    file_text = self.source_file.curr_file_content
-                    note_hierarchy = self.get_heading_hierarchy(file_text, self.note_start_span)
+                    note_hierarchy = self.source_file.get_heading_hierarchy(self.note_start_span)
 
                     field = ContextField(relative_path, note_hierarchy, field_name)
                     self.fields.append(field)
@@ -214,8 +248,34 @@ class Note:
                     field = LinkField(file_name, vault_name, field_name)
                     self.fields.append(field)
 
-        for field in self.fields:
-            field.transform()
+        # the fields are not transformed here, only when the note is sent to anki, see get_rendered_fields
+
+    def get_rendered_fields(self) -> dict:
+        """
+        transforms the fields the first time they are needed, which is when the note is sent to anki,
+        so notes that are never sent are never rendered
+        """
+        if self.rendered_fields is None:
+            self.rendered_fields = {
+                field.get_field_name(): field.get_field_value() for field in self.fields
+            }
+        return self.rendered_fields
+
+    def get_fingerprint(self) -> str:
+        """
+        hash of everything that is sent to anki when the note is updated,
+        if it did not change since the last update, the update can be skipped
+        """
+        content = json.dumps(
+            {
+                "modelName": self.note_type.to_anki_dict(),
+                "deckName": self.target_deck,
+                "tags": self.tags,
+                "fields": self.get_rendered_fields(),
+            },
+            sort_keys=True,
+        )
+        return compute_hash(content.encode("utf-8"))
 
     def to_anki_dict(self):
         if self.state == State.NEW:  # to be used with addNote in anki
@@ -223,10 +283,7 @@ class Note:
                 "modelName": self.note_type.to_anki_dict(),
                 "deckName": self.target_deck,
                 "tags": self.tags,
-                "fields": {
-                    field.get_field_name(): field.get_field_value()
-                    for field in self.fields
-                },
+                "fields": self.get_rendered_fields(),
                 "options": {"allowDuplicate": True}
             }
         else:  # to be used with updateNote in anki
@@ -235,54 +292,43 @@ class Note:
                 "modelName": self.note_type.to_anki_dict(),
                 "deckName": self.target_deck,
                 "tags": self.tags,
-                "fields": {
-                    field.get_field_name(): field.get_field_value()
-                    for field in self.fields
-                },
+                "fields": self.get_rendered_fields(),
             }
-        
-    def get_heading_hierarchy(self, text, position):
-        # Regex pattern to match Markdown headings (ATX style)
-        heading_regex = re.compile(r'^(#{1,6})\s+(.*)', re.MULTILINE)
-        
-        # Find all headings in the markdown text
-        headings = []
-        for match in heading_regex.finditer(text):
-            level = len(match.group(1))  # Number of '#' symbols indicates the level
-            heading_text = match.group(2).strip()
-            start_pos = match.start()
-            
-            # Store heading details
-            headings.append({
-                'level': level,
-                'text': heading_text,
-                'position': start_pos
-            })
-        
-        # Initialize hierarchy
-        hierarchy = []
-        current_level_headings = {}
-        
-        # Process headings up to the given position
-        for heading in headings:
-            if heading['position'] > position:
-                break  # We've passed the position; stop processing
-            
-            level = heading['level']
-            text = heading['text']
-            
-            # Update current level headings
-            current_level_headings[level] = text
-            
-            # Remove deeper levels
-            keys_to_remove = [lvl for lvl in current_level_headings if lvl > level]
-            for key in keys_to_remove:
-                del current_level_headings[key]
-            
-            # Build hierarchy
-            hierarchy = [current_level_headings[lvl] for lvl in sorted(current_level_headings)]
-        
-        return hierarchy
+
+
+class NoteRecord:
+    """
+    compact and picklable summary of a Note, it is what the worker processes send back
+    to the main process, which turns it into a Note again with Note.from_record
+    """
+
+    note_type_index: Optional[int]
+    state: State
+    id: Optional[int]
+    note_start_span: int
+    note_end_span: int
+    original_note_text: str
+    id_location_in_file: int
+    target_deck: str
+    tags: List[str]
+    fields: List[tuple]
+    medias: List[Any]
+
+    def __init__(self, note: Note, note_types: List["NoteType"]):
+        if note.note_type is None:
+            self.note_type_index = None
+        else:
+            self.note_type_index = note_types.index(note.note_type)
+        self.state = note.state
+        self.id = note.id
+        self.note_start_span = note.note_start_span
+        self.note_end_span = note.note_end_span
+        self.original_note_text = note.original_note_text
+        self.id_location_in_file = note.id_location_in_file
+        self.target_deck = note.target_deck
+        self.tags = note.tags
+        self.fields = list(note.get_rendered_fields().items())
+        self.medias = note.medias
 
 
 class NoteVariant(enum.Enum):
@@ -308,12 +354,26 @@ class NoteVariant(enum.Enum):
 class NoteType:
     name: str
     regexes: List[str]
+    patterns: List[re.Pattern]
+    required_literals: List[List[str]]
     fields: List[dict]
 
     def __init__(self, note_variant: NoteVariant, note_type: dict):
         self.note_type = note_variant
         self.name = note_variant.get_string()
         self.regexes = note_type["regexes"]
+        self.patterns = [self.compile_regex(regex) for regex in self.regexes]
+
+        # the literals that a text needs to contain for each pattern to match, either configured for
+        # the whole note type or derived from each regex
+        configured_literals = note_type.get("required_literals")
+        if configured_literals:
+            self.required_literals = [list(configured_literals) for _ in self.patterns]
+        else:
+            self.required_literals = [
+                get_required_literals(pattern.pattern, pattern.flags)
+                for pattern in self.patterns
+            ]
 
         fields = note_type["fields"]
 
@@ -324,6 +384,26 @@ class NoteType:
         else:
             raise ValueError("Config entry for fields must be dict or list of dicts")
 
+    def compile_regex(self, regex: str) -> re.Pattern:
+        """
+        compiles the regex with the ID pattern appended, so an invalid regex fails when the config is loaded
+        """
+        try:
+            return re.compile(regex + ID_REGEX_PATTERN, re.MULTILINE | re.UNICODE)  # | re.DEBUG for debugging
+        except re.error as err:
+            raise ValueError(f"Invalid regex for the note type {self.name}: {regex!r}: {err}") from err
+
+    def get_candidate_patterns(self, text: str) -> List[re.Pattern]:
+        """
+        returns the patterns that may match the text, the others are rejected with a substring check
+        because the text misses one of their required literals
+        """
+        return [
+            pattern
+            for pattern, literals in zip(self.patterns, self.required_literals, strict=True)
+            if all(literal in text for literal in literals)
+        ]
+
     def to_anki_dict(self):
         return self.name
 
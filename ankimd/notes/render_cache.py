@@ -0,0 +1,160 @@
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from ankimd.notes.transformers.fields import TRANSFORMERS_VERSION
+from ankimd.utils.helpers import compute_hash
+
+logger = logging.getLogger(__name__)
+
+
+class RenderCache:
+    """
+    on disk cache of the transformed text of the fields.
+
+    The same raw text of a field always gives the same html, so the result of the transformers is stored
+    keyed by the field class, the hash of the raw text, the vault name and the version of the transformers.
+    The cache is bounded in size, the least recently used entries are evicted every time it is flushed.
+
+    Reads go to the database, writes and the access times are kept in memory until the cache is flushed,
+    so the worker processes can open the cache read only and hand their new entries over to the main process.
+    """
+
+    path: Path
+    max_bytes: int
+    readonly: bool
+    pending: Dict[str, str]
+    used_keys: List[str]
+
+    def __init__(self, path: Path, max_bytes: int, readonly: bool = False):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.readonly = readonly
+        self.pending = {}
+        self.used_keys = []
+        # the fields may be rendered from several threads when the stages of the sync overlap
+        self.lock = threading.Lock()
+        if readonly:
+            # as_uri escapes the characters that have a meaning in a uri, like # or ?
+            self.connection = sqlite3.connect(
+                self.path.resolve().as_uri() + "?mode=ro", uri=True, check_same_thread=False
+            )
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS fields (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )
+                """
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS fields_last_used ON fields (last_used)"
+            )
+            self.connection.commit()
+
+    @staticmethod
+    def make_key(field_class: str, text: str, vault_name: str, *extra: str) -> str:
+        text_hash = compute_hash(text.encode("utf-8"))
+        key = "\0".join([field_class, text_hash, vault_name, TRANSFORMERS_VERSION, *extra])
+        return compute_hash(key.encode("utf-8"))
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            row = self.connection.execute(
+                "SELECT value FROM fields WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.used_keys.append(key)
+            return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        with self.lock:
+            self.pending[key] = value
+
+    def take_pending(self) -> Dict[str, str]:
+        """returns and forgets the entries that were not written yet"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+    def flush(self) -> None:
+        if self.readonly:
+            return
+        now = time.time()
+        pending = self.take_pending()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO fields (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                [(key, value, len(value.encode("utf-8")), now) for key, value in pending.items()],
+            )
+            self.connection.executemany(
+                "UPDATE fields SET last_used = ? WHERE key = ?",
+                [(now, key) for key in self.used_keys],
+            )
+            self.used_keys = []
+        if pending:
+            self.evict()
+
+    def evict(self) -> None:
+        """deletes the least recently used entries until the cache fits in max_bytes"""
+        if self.readonly:
+            return
+        total = 0
+        keys_to_evict = []
+        rows = self.connection.execute(
+            "SELECT key, size FROM fields ORDER BY last_used DESC"
+        )
+        for key, size in rows:
+            total += size
+            if total > self.max_bytes:
+                keys_to_evict.append((key,))
+        if keys_to_evict:
+            logger.debug(f"evicting {len(keys_to_evict)} fields from the render cache")
+            with self.connection:
+                self.connection.executemany("DELETE FROM fields WHERE key = ?", keys_to_evict)
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
+
+
+# the cache used by the fields of the current process, set with set_render_cache
+_render_cache: Optional[RenderCache] = None
+
+
+def set_render_cache(cache: Optional[RenderCache]) -> None:
+    global _render_cache
+    _render_cache = cache
+
+
+def get_render_cache() -> Optional[RenderCache]:
+    return _render_cache
+
+
+def cached_transform(
+    text: str, transform: Callable[[str], str], field_class: str, vault_name: str, *extra: str
+) -> str:
+    """
+    returns the transformed text from the render cache, only transforming it on a cache miss.
+    Without a render cache, the text is always transformed
+    """
+    cache = get_render_cache()
+    if cache is None:
+        return transform(text)
+    key = RenderCache.make_key(field_class, text, vault_name, *extra)
+    rendered = cache.get(key)
+    if rendered is None:
+        rendered = transform(text)
+        cache.put(key, rendered)
+    return rendered
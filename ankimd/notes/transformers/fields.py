@@ -1,6 +1,8 @@
 import re
+import threading
 
 import markdown
+import pygments
 from markdown.extensions.codehilite import CodeHiliteExtension
 
 from ankimd.notes.transformers.utils import create_link
@@ -13,6 +15,10 @@ from ankimd.utils.patterns import (
     IMAGE_URL_REGEX,
 )
 
+# bump the first number whenever the output of the transformers changes, so the fields cached
+# with the old output are rendered again
+TRANSFORMERS_VERSION = f"1-markdown{markdown.__version__}-pygments{pygments.__version__}"
+
 
 def replace_with_link(text: str, vault_name: str) -> str:
     def re_sub_repl_dynamic(match: re.Match) -> str:
@@ -45,21 +51,35 @@ def to_anki_math_transformer(text: str) -> str:
     return text
 
 
+# every thread (and so every worker process) keeps its own Markdown instance, see get_markdown_renderer
+_markdown_renderers = threading.local()
+
+
+def get_markdown_renderer() -> markdown.Markdown:
+    """
+    returns the Markdown instance of the current thread, reset so it can convert the next field.
+    Building a Markdown instance registers all the extensions, which is much slower than resetting one
+    """
+    renderer = getattr(_markdown_renderers, "renderer", None)
+    if renderer is None:
+        # fenced code so we can get the language and hilite to get the highlights with css
+        renderer = markdown.Markdown(
+            extensions=[
+                "fenced_code",
+                CodeHiliteExtension(css_class="highlight"),
+                "footnotes",
+                "md_in_html",
+                "tables",
+                "nl2br",
+                "sane_lists",
+            ],
+        )
+        _markdown_renderers.renderer = renderer
+    return renderer.reset()
+
+
 def create_code_blocks_transformer(text: str) -> str:
-    # fenced code so we can get the language and hilite to get the highlights with css
-    text = markdown.markdown(
-        text,
-        extensions=[
-            "fenced_code",
-            CodeHiliteExtension(css_class="highlight"),
-            "footnotes",
-            "md_in_html",
-            "tables",
-            "nl2br",
-            "sane_lists",
-        ],
-    )
-    return text
+    return get_markdown_renderer().convert(text)
 
 def strip_paragraph_tags(text: str) -> str:
     return text.replace("<p>", "").replace("</p>", "")
@@ -1,72 +1,239 @@
+import asyncio
 import logging
-from typing import List
+from pathlib import Path
+from typing import List, Optional, Set
 
+from ankimd.anki.async_manager import AsyncAnkiManager
 from ankimd.anki.manager import (
     AnkiManager,
 )
 from ankimd.config_parser import NewConfig
-from ankimd.notes.manager import set_new_ids
-from ankimd.notes.note import NoteType
-from ankimd.utils.helpers import open_cache, write_hashes_to_file
+from ankimd.media import Audio
+from ankimd.media_index import MediaIndex
+from ankimd.notes.manager import NotesManager, set_new_ids
+from ankimd.notes.note import Note, NoteType
+from ankimd.notes.render_cache import RenderCache, set_render_cache
+from ankimd.scheduler import Stage, run_stages
+from ankimd.state import StateStore
+from ankimd.utils.constants import SUPPORTED_TEXT_EXTS
+from ankimd.utils.helpers import get_files_paths, is_scanned_dir, is_scanned_file
 from ankimd.vault import VaultManager
 
 logger = logging.getLogger(__name__)
 
 
-def run(config: NewConfig):
-    vault_name = config.vault.dir_path.name
-    hashes_path = config.hashes_cache_dir / f".{vault_name}_file_hashes.json"
-    hashes = open_cache(hashes_path)
-    note_types: List[NoteType] = config.get_note_types()
-    anki_requester = AnkiManager(config.globals.anki.url)
+class SyncRun:
+    """
+    one sync of the vault with anki, split in stages that declare which stages they depend on,
+    so that independent stages, like uploading the media and updating the notes, can overlap.
+    See get_stages for the order and the dependencies of the stages
+    """
 
-    ids = anki_requester.get_ids()
-    medias_in_anki = anki_requester.get_medias(config.globals.anki.fine_grained_image_search)
-    pics_in_anki = medias_in_anki["images"]
-    audios_in_anki = medias_in_anki["audios"]
+    config: NewConfig
+    vault: VaultManager
+    notes_manager: NotesManager
+    notes_to_add: List[Note]
+    notes_to_edit: List[Note]
+    notes_to_delete: List[Note]
 
-    vault = VaultManager(
-        config.vault.dir_path,
-        config.vault.exclude_dirs_from_scan,
-        config.vault.exclude_dotted_dirs_from_scan,
-        config.vault.file_patterns_to_exclude,
-        note_types,
-    )
+    def __init__(self, config: NewConfig, io_workers: int = 1, jobs: int = 1):
+        self.config = config
+        self.io_workers = io_workers
+        self.jobs = jobs
+        self.vault_name = config.vault.dir_path.name
+        self.note_types: List[NoteType] = config.get_note_types()
+        anki_config = config.globals.anki
+        self.anki = AsyncAnkiManager(
+            AnkiManager(
+                anki_config.url,
+                connect_timeout=anki_config.connect_timeout,
+                read_timeout=anki_config.read_timeout,
+                max_actions_per_request=anki_config.max_actions_per_request,
+                max_request_bytes=int(anki_config.max_request_mb * 1024 * 1024),
+                target_request_seconds=anki_config.target_request_seconds,
+                max_media_memory_bytes=int(anki_config.max_media_memory_mb * 1024 * 1024),
+                upload_media_by_path=anki_config.upload_media_by_path(),
+            )
+        )
+        self.render_cache = None
+        # kept between the syncs of a watch session, see sync
+        self.state_loaded = False
+        self.changed_paths: Optional[Set[Path]] = None
+        self.file_paths: Optional[Set[Path]] = None
+        self.pics_in_anki: Optional[Set[str]] = None
+        self.audios_in_anki: Optional[Set[str]] = None
 
-    vault.set_new_files(hashes)
+    def sync(self, changed_paths: Optional[Set[Path]] = None, overlap: bool = False) -> None:
+        """
+        runs the stages of the sync. A SyncRun can sync several times, like in watch mode: the state files,
+        the render cache and the names of the medias in anki are only loaded by the first sync.
+        With changed_paths, the vault is not walked again, only these paths are looked at
+        """
+        self.changed_paths = changed_paths
+        asyncio.run(run_stages(self.get_stages(), overlap=overlap))
 
-    notes_manager = vault.get_notes_from_new_files()
-    notes_manager.categorize_notes(ids)
-    notes_manager.load_media_data(config.vault.medias_dir_path)
-    notes_manager.categorize_medias(pics_in_anki, audios_in_anki)
-    medias = notes_manager.get_media_to_add()
+    def get_stages(self) -> List[Stage]:
+        return [
+            Stage("load_state", self.load_state),
+            Stage("fetch_medias_in_anki", self.fetch_medias_in_anki),
+            Stage("scan_vault", self.scan_vault, ["load_state"]),
+            Stage("fetch_ids", self.fetch_ids, ["scan_vault"]),
+            Stage("create_decks", self.create_decks, ["scan_vault"]),
+            Stage("categorize_notes", self.categorize_notes, ["fetch_ids"]),
+            Stage("select_notes_to_update", self.select_notes_to_update, ["categorize_notes"]),
+            Stage("delete_notes", self.delete_notes, ["categorize_notes"]),
+            # the ids of the added notes are inserted in the file content after the deleted ids are erased from it.
+            # Once anki added the notes, their ids have to be written to the files whatever happens in the other
+            # stages, otherwise the next run adds them again, so the stage writes the files and is protected
+            Stage("add_notes", self.add_notes, ["create_decks", "delete_notes"], protected=True),
+            Stage("update_notes", self.update_notes, ["create_decks", "select_notes_to_update"]),
+            Stage("index_medias", self.index_medias, ["load_state"]),
+            Stage("categorize_medias", self.categorize_medias, ["scan_vault", "fetch_medias_in_anki", "index_medias"]),
+            Stage("verify_medias", self.verify_medias, ["categorize_medias"]),
+            Stage("store_medias", self.store_medias, ["verify_medias"]),
+            Stage("save_state", self.save_state, ["add_notes", "update_notes", "store_medias"]),
+        ]
 
-    notes_to_edit = notes_manager.get_all_notes_to_edit()
-    notes_to_add = notes_manager.get_all_notes_to_add()
-    notes_to_delete = notes_manager.get_all_notes_to_delete()
+    def load_state(self) -> None:
+        if self.state_loaded:
+            return
+        self.state_loaded = True
+        hashes_cache_dir = self.config.hashes_cache_dir
+        self.state = StateStore.open(
+            hashes_cache_dir / f".{self.vault_name}_state.sqlite3",
+            legacy_dir=hashes_cache_dir,
+            vault_name=self.vault_name,
+        )
+        self.manifest = self.state.load_file_manifest()
+        self.fingerprints = self.state.load_note_fingerprints()
+        self.media_manifest = self.state.load_media_manifest()
+        self.media_index = MediaIndex(
+            [self.config.vault.medias_dir_path, self.config.vault.dir_path],
+            dirs=self.state.load_media_dirs(),
+        )
+        if self.config.render_cache_size_mb > 0:
+            self.render_cache = RenderCache(
+                hashes_cache_dir / f".{self.vault_name}_render_cache.sqlite3",
+                max_bytes=self.config.render_cache_size_mb * 1024 * 1024,
+            )
+        set_render_cache(self.render_cache)
 
-    # Remove notes from notes_to_edit which are part of notes_to_delete by file id
-    notes_to_edit = [note for note in notes_to_edit if note.id not in {note.id for note in notes_to_delete}]
+    async def fetch_medias_in_anki(self) -> None:
+        if self.pics_in_anki is not None:
+            # already listed by a previous sync, and kept up to date with the uploads since
+            return
+        medias_in_anki = await self.anki.get_medias()
+        self.pics_in_anki = medias_in_anki["images"]
+        self.audios_in_anki = medias_in_anki["audios"]
 
-    decks_to_create = notes_manager.get_needed_target_decks()
-    anki_requester.create_decks(decks_to_create)
+    def scan_vault(self) -> None:
+        candidate_paths = None
+        if self.changed_paths is not None and self.file_paths is not None:
+            candidate_paths = sorted(self.apply_changes_to_file_paths())
+        self.vault = VaultManager(
+            self.config.vault.dir_path,
+            self.config.vault.exclude_dirs_from_scan,
+            self.config.vault.exclude_dotted_dirs_from_scan,
+            self.config.vault.file_patterns_to_exclude,
+            self.note_types,
+            io_workers=self.io_workers,
+            jobs=self.jobs,
+            file_paths=sorted(self.file_paths) if candidate_paths is not None else None,
+        )
+        self.file_paths = set(self.vault.file_paths)
+        self.vault.set_new_files(self.manifest, candidate_paths)
+        self.notes_manager = self.vault.get_notes_from_new_files()
 
-    # Delete notes
-    anki_requester.delete_notes(notes_to_delete)
-    
+    def apply_changes_to_file_paths(self) -> Set[Path]:
+        """
+        updates the files of the vault known from the previous sync with the changed paths,
+        and returns the files that may have changed, including the ones of the directories created or moved in
+        """
+        candidate_paths = set()
+        vault_config = self.config.vault
+        exclusions = (
+            vault_config.exclude_dirs_from_scan,
+            vault_config.exclude_dotted_dirs_from_scan,
+            vault_config.file_patterns_to_exclude,
+        )
+        for path in self.changed_paths:
+            if path.is_dir():  # a directory created or moved into the vault
+                if is_scanned_dir(path, vault_config.dir_path, *exclusions[:2]):
+                    candidate_paths.update(get_files_paths(path, *exclusions))
+            elif path.is_file():
+                if is_scanned_file(path, vault_config.dir_path, *exclusions):
+                    candidate_paths.add(path)
+            else:  # a file or a directory removed from the vault
+                self.file_paths.discard(path)
+                self.file_paths = {file_path for file_path in self.file_paths if path not in file_path.parents}
+        self.file_paths.update(candidate_paths)
+        return candidate_paths
 
-    files_with_deleted_notes = notes_manager.get_files_with_deleted_notes()
-    for file in files_with_deleted_notes:
-        file.erase_deleted_ids_from_file_content()
+    async def fetch_ids(self) -> None:
+        if self.manifest.is_empty():
+            # cold start, every file is new, so fetching all the IDs at once is cheaper
+            self.ids = await self.anki.get_ids()
+        else:
+            self.ids = await self.anki.get_ids(self.notes_manager.get_referenced_ids())
+
+    async def create_decks(self) -> None:
+        decks_to_create = self.notes_manager.get_needed_target_decks()
+        await self.anki.create_decks(decks_to_create)
+
+    def categorize_notes(self) -> None:
+        self.notes_manager.categorize_notes(self.ids)
+        self.notes_to_add = self.notes_manager.get_all_notes_to_add()
+        self.notes_to_delete = self.notes_manager.get_all_notes_to_delete()
+
+        # Remove notes from notes_to_edit which are part of notes_to_delete by file id
+        deleted_ids = {note.id for note in self.notes_to_delete}
+        notes_to_edit = [
+            note for note in self.notes_manager.get_all_notes_to_edit() if note.id not in deleted_ids
+        ]
+
+        # Only update the notes that changed since they were last sent to anki
+        self.notes_without_fingerprint = [
+            note for note in notes_to_edit if self.fingerprints.get(note.id) is None
+        ]
+        self.notes_to_edit = [note for note in notes_to_edit if self.fingerprints.has_changed(note)]
+
+    async def select_notes_to_update(self) -> None:
+        if not self.config.globals.anki.remote_diff or not self.notes_without_fingerprint:
+            logger.info(f"{len(self.notes_to_edit)} existing notes changed since the last run")
+            return
+        # without local state, ask anki which of these notes actually differ
+        differing_notes = await self.anki.get_notes_differing_from_anki(self.notes_without_fingerprint)
+        differing_ids = {note.id for note in differing_notes}
+        matching_notes = [note for note in self.notes_without_fingerprint if note.id not in differing_ids]
+        self.fingerprints.update(matching_notes)
+        matching_ids = {note.id for note in matching_notes}
+        self.notes_to_edit = [note for note in self.notes_to_edit if note.id not in matching_ids]
+        logger.info(f"{len(self.notes_to_edit)} existing notes changed since the last run")
+
+    async def delete_notes(self) -> None:
+        await self.anki.delete_notes(self.notes_to_delete)
+        self.fingerprints.remove(self.notes_to_delete)
+
+        files_with_deleted_notes = self.notes_manager.get_files_with_deleted_notes()
+        for file in files_with_deleted_notes:
+            file.erase_deleted_ids_from_file_content()
+
+    async def add_notes(self) -> None:
+        try:
+            await self.add_new_notes()
+        finally:
+            self.write_files()
+
+    async def add_new_notes(self) -> None:
+        if self.notes_to_add == []:
+            return
+        check_new_response = await self.anki.check_new_notes(self.notes_to_add)
 
-    if notes_to_add != []:
-        check_new_response = anki_requester.check_new_notes(notes_to_add)
-        
         # Filter notes that can be added based on check response and log errors
         notes_to_add_clean = []
         notes_with_responses = []
         if check_new_response is not None:
-            notes_with_responses = zip(notes_to_add, check_new_response)
+            notes_with_responses = zip(self.notes_to_add, check_new_response)
         for note, check in notes_with_responses:
             if check.get('canAdd', True):
                 notes_to_add_clean.append(note)
@@ -74,27 +241,85 @@ def run(config: NewConfig):
                 logger.error(f"Cannot add note from file '{note.source_file.file_name}': {note.curr_note_text}")
 
         # Add new notes
-        add_response = anki_requester.adds_new_notes(notes_to_add_clean)  
-
+        add_response = await self.anki.adds_new_notes(notes_to_add_clean)
 
         if add_response:
             set_new_ids(add_response)
-            files_with_added_notes = notes_manager.get_files_with_added_notes()
+            self.fingerprints.update(note for note, _ in add_response)
+            files_with_added_notes = self.notes_manager.get_files_with_added_notes()
             for file in files_with_added_notes:
                 file.write_new_ids_to_file_content()
 
-    # Update existing notes
-    anki_requester.updates_existing_notes(notes_to_edit)
+    async def update_notes(self) -> None:
+        await self.anki.updates_existing_notes(self.notes_to_edit)
+        await self.anki.ensure_correct_deck(self.notes_to_edit)
+        self.fingerprints.update(self.notes_to_edit)
+
+    def index_medias(self) -> None:
+        if self.changed_paths is not None and all(path.suffix in SUPPORTED_TEXT_EXTS for path in self.changed_paths):
+            # only notes changed since the previous sync, the media index is up to date
+            return
+        self.media_index.scan(
+            self.config.vault.exclude_dirs_from_scan,
+            self.config.vault.exclude_dotted_dirs_from_scan,
+        )
+
+    def categorize_medias(self) -> None:
+        if self.config.globals.anki.fine_grained_image_search:
+            # the content of every media is compared with the media manifest
+            self.notes_manager.load_media_data(self.media_index)
+            self.notes_manager.categorize_medias(self.pics_in_anki, self.audios_in_anki, self.media_manifest)
+        else:
+            self.notes_manager.categorize_medias(self.pics_in_anki, self.audios_in_anki)
+
+    async def verify_medias(self) -> None:
+        # only the medias missing from the media manifest, or changed since they were uploaded, are downloaded
+        medias_to_verify = self.notes_manager.get_medias_to_verify()
+        if not medias_to_verify:
+            return
+        hashes_in_anki = await self.anki.get_media_hashes(medias_to_verify)
+        stored_medias = self.notes_manager.categorize_verified_medias(hashes_in_anki)
+        self.media_manifest.update(stored_medias)
+
+    async def store_medias(self) -> None:
+        # only the medias that are going to be uploaded need their data
+        medias_to_add = self.notes_manager.load_media_data(self.media_index, self.notes_manager.get_media_to_add())
+        await self.anki.store_media_files(medias_to_add)
+        for media in medias_to_add:
+            (self.audios_in_anki if isinstance(media, Audio) else self.pics_in_anki).add(media.filename)
+        if self.config.globals.anki.fine_grained_image_search:
+            # the hashes are already known, the media manifest is not used, and not worth reading the medias, otherwise
+            self.media_manifest.update(medias_to_add)
+
+    def write_files(self) -> None:
+        # Rewrite updated files
+        self.vault.write_updated_content_to_files()
 
-    # Rewrite updated files
-    vault.write_updated_content_to_files()
+    def save_state(self) -> None:
+        self.vault.update_manifest(self.manifest)
+        self.state.save(self.manifest, self.fingerprints, self.media_manifest, self.media_index)
+        if self.render_cache is not None:
+            # in watch mode the cache is only closed when the watch stops, so every sync writes its new fields
+            self.render_cache.flush()
 
-    anki_requester.ensure_correct_deck(notes_to_edit)
-    anki_requester.store_media_files(medias)
+    def close(self) -> None:
+        self.anki.close()
+        if self.state_loaded:
+            self.state.close()
+        if self.render_cache is not None:
+            self.render_cache.close()
+            set_render_cache(None)
 
-    curr_hashes = vault.get_curr_file_hashes()
 
-    write_hashes_to_file(curr_hashes, hashes_path)
+def run(config: NewConfig, io_workers: int = 1, jobs: int = 1, overlap: bool = False):
+    """
+    syncs the vault with anki, with overlap the independent stages of the sync run at the same time
+    """
+    sync_run = SyncRun(config, io_workers=io_workers, jobs=jobs)
+    try:
+        sync_run.sync(overlap=overlap)
+    finally:
+        sync_run.close()
 
     # TODO need to change the Vault manager to manage IO operations with the files inside the vault
     # TODO need to error handle when we try to add a duplicate note
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+from typing import Any, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    """
+    a step of the sync, which can only start when the stages it depends on are done.
+    The function of the stage is either a coroutine function, for the stages that wait on anki,
+    or a plain function, for the local work, which runs in a thread when stages overlap.
+    A protected stage is not cancelled once it started when another stage fails, it always runs to its end
+    """
+
+    name: str
+    func: Callable[[], Any]
+    depends_on: List[str]
+    protected: bool
+
+    def __init__(
+        self, name: str, func: Callable[[], Any], depends_on: Optional[List[str]] = None, protected: bool = False
+    ):
+        self.name = name
+        self.func = func
+        self.depends_on = depends_on or []
+        self.protected = protected
+
+    async def run(self, in_thread: bool) -> Any:
+        logger.debug(f"starting stage {self.name}")
+        if asyncio.iscoroutinefunction(self.func):
+            return await self.func()
+        if in_thread:
+            # so the local work overlaps with the requests of the other stages
+            return await asyncio.to_thread(self.func)
+        return self.func()
+
+
+async def run_stages(stages: List[Stage], overlap: bool = False) -> None:
+    """
+    Run the stages, each one after all the stages it depends on.
+
+    The stages have to be given in an order where every stage comes after its dependencies.
+    Without overlap, they run one after another in that order. With overlap, every stage starts
+    as soon as its dependencies are done, so independent stages run at the same time.
+    """
+    seen = set()
+    for stage in stages:
+        missing = [name for name in stage.depends_on if name not in seen]
+        if missing:
+            raise ValueError(f"Stage {stage.name} depends on stages that do not run before it: {missing}")
+        seen.add(stage.name)
+
+    if not overlap:
+        for stage in stages:
+            await stage.run(in_thread=False)
+        return
+
+    tasks = {}
+    protected_runs = []
+
+    async def run_after_dependencies(stage: Stage) -> Any:
+        await asyncio.gather(*(tasks[name] for name in stage.depends_on))
+        if not stage.protected:
+            return await stage.run(in_thread=True)
+        run = asyncio.ensure_future(stage.run(in_thread=True))
+        protected_runs.append(run)
+        return await asyncio.shield(run)
+
+    for stage in stages:
+        tasks[stage.name] = asyncio.create_task(run_after_dependencies(stage), name=stage.name)
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        # the protected stages that already started keep running, and are waited for before giving up
+        await asyncio.gather(*protected_runs, return_exceptions=True)
+        raise
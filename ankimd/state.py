@@ -0,0 +1,276 @@
+import json
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+from ankimd.manifest import (
+    MANIFEST_VERSION,
+    FileManifest,
+    FileStat,
+    ManifestEntry,
+    MediaManifest,
+    NoteFingerprints,
+)
+from ankimd.media_index import MediaIndex
+
+logger = logging.getLogger(__name__)
+
+STATE_VERSION = 1
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+    """
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        hash TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS files_hash ON files (hash)",
+    "CREATE TABLE IF NOT EXISTS legacy_hashes (hash TEXT PRIMARY KEY)",
+    """
+    CREATE TABLE IF NOT EXISTS notes (
+        id INTEGER PRIMARY KEY,
+        file TEXT,
+        offset INTEGER,
+        fingerprint TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS notes_file ON notes (file)",
+    """
+    CREATE TABLE IF NOT EXISTS media (
+        name TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        hash TEXT NOT NULL,
+        uploaded_at REAL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS media_dirs (
+        path TEXT PRIMARY KEY,
+        mtime_ns INTEGER NOT NULL,
+        subdirs TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS media_files (
+        dir TEXT NOT NULL,
+        name TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        PRIMARY KEY (dir, name)
+    )
+    """,
+]
+
+
+class StateStore:
+    """
+    the state of the sync kept between runs, in one SQLite database:
+    the files of the vault (path, stat, hash), the notes sent to anki (id, file, offset, fingerprint)
+    the medias uploaded to anki (name, size, hash, uploaded_at) and the media index
+    (the directories with their mtime and subdirectories, and their media files with their size and mtime).
+
+    The tables are loaded in memory at the start of the sync, and save only writes the rows that changed
+    or were removed since, all in one transaction, so an interrupted sync never leaves a half written state.
+
+    The first time the database is opened, the json files the state was kept in before are imported.
+    """
+
+    path: Path
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # the stages of the sync may run in threads when they overlap
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+    @classmethod
+    def open(cls, path: Path, legacy_dir: Optional[Path] = None, vault_name: str = "") -> "StateStore":
+        logger.info(f"Opening state store at {path}")
+        store = cls(path)
+        row = store.connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None:
+            with store.connection:
+                if legacy_dir is not None:
+                    store._import_legacy_json(Path(legacy_dir), vault_name)
+                store.connection.execute(
+                    "INSERT INTO meta (key, value) VALUES ('version', ?)", (str(STATE_VERSION),)
+                )
+        elif int(row[0]) != STATE_VERSION:
+            raise ValueError(f"State store {path} has the unknown version {row[0]}")
+        return store
+
+    def _import_legacy_json(self, legacy_dir: Path, vault_name: str) -> None:
+        """imports the state kept in json files by the previous versions, the files are left in place"""
+
+        def read_json(name: str):
+            path = legacy_dir / f".{vault_name}_{name}.json"
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                return None
+            logger.info(f"Importing {path} in the state store")
+            if isinstance(data, dict) and data.get("version") != MANIFEST_VERSION:
+                logger.warning(f"Ignoring {path} with unknown version {data.get('version')}")
+                return None
+            return data
+
+        manifest = read_json("manifest")
+        if manifest is not None:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, hash) VALUES (?, ?, ?, ?, ?)",
+                [(path, *values) for path, values in manifest["files"].items()],
+            )
+        else:
+            legacy_hashes = read_json("file_hashes")
+            if legacy_hashes:
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO legacy_hashes (hash) VALUES (?)",
+                    [(file_hash,) for file_hash in legacy_hashes],
+                )
+        fingerprints = read_json("note_fingerprints")
+        if fingerprints is not None:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO notes (id, file, offset, fingerprint) VALUES (?, NULL, NULL, ?)",
+                [(int(note_id), fingerprint) for note_id, fingerprint in fingerprints["notes"].items()],
+            )
+        medias = read_json("media_manifest")
+        if medias is not None:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO media (name, size, hash, uploaded_at) VALUES (?, ?, ?, NULL)",
+                [(name, size, media_hash) for name, (size, media_hash) in medias["medias"].items()],
+            )
+
+    def load_file_manifest(self) -> FileManifest:
+        with self.lock:
+            entries = {
+                path: ManifestEntry(FileStat(size, mtime_ns, inode), file_hash)
+                for path, size, mtime_ns, inode, file_hash in self.connection.execute(
+                    "SELECT path, size, mtime_ns, inode, hash FROM files"
+                )
+            }
+            legacy_hashes = [row[0] for row in self.connection.execute("SELECT hash FROM legacy_hashes")]
+        return FileManifest(entries, legacy_hashes)
+
+    def load_note_fingerprints(self) -> NoteFingerprints:
+        fingerprints = NoteFingerprints()
+        with self.lock:
+            for note_id, file, offset, fingerprint in self.connection.execute(
+                "SELECT id, file, offset, fingerprint FROM notes"
+            ):
+                fingerprints.fingerprints[note_id] = fingerprint
+                fingerprints.locations[note_id] = (file, offset)
+        return fingerprints
+
+    def load_media_manifest(self) -> MediaManifest:
+        media_manifest = MediaManifest()
+        with self.lock:
+            for name, size, media_hash, uploaded_at in self.connection.execute(
+                "SELECT name, size, hash, uploaded_at FROM media"
+            ):
+                media_manifest.entries[name] = (size, media_hash, uploaded_at)
+        return media_manifest
+
+    def load_media_dirs(self) -> Dict[str, dict]:
+        """the directories of the media index, see MediaIndex"""
+        with self.lock:
+            dirs = {
+                path: {"mtime_ns": mtime_ns, "files": {}, "dirs": json.loads(subdirs)}
+                for path, mtime_ns, subdirs in self.connection.execute(
+                    "SELECT path, mtime_ns, subdirs FROM media_dirs"
+                )
+            }
+            for dir_path, name, size, mtime_ns in self.connection.execute(
+                "SELECT dir, name, size, mtime_ns FROM media_files"
+            ):
+                if dir_path in dirs:
+                    dirs[dir_path]["files"][name] = [size, mtime_ns]
+        return dirs
+
+    def save(
+        self,
+        manifest: FileManifest,
+        fingerprints: NoteFingerprints,
+        media_manifest: MediaManifest,
+        media_index: Optional[MediaIndex] = None,
+    ) -> None:
+        """writes the changes of the sync in one transaction"""
+        media_dirs_changed = sorted(media_index.changed) if media_index is not None else []
+        media_dirs_removed = sorted(media_index.removed) if media_index is not None else []
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, hash) VALUES (?, ?, ?, ?, ?)",
+                [(path, *manifest.entries[path].to_list()) for path in manifest.changed],
+            )
+            self.connection.executemany(
+                "DELETE FROM files WHERE path = ?", [(path,) for path in manifest.removed]
+            )
+            if manifest.entries and manifest.legacy_hashes:
+                # every file has its own entry now
+                self.connection.execute("DELETE FROM legacy_hashes")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO notes (id, file, offset, fingerprint) VALUES (?, ?, ?, ?)",
+                [
+                    (note_id, *fingerprints.locations.get(note_id, (None, None)), fingerprints.fingerprints[note_id])
+                    for note_id in fingerprints.changed
+                ],
+            )
+            self.connection.executemany(
+                "DELETE FROM notes WHERE id = ?", [(note_id,) for note_id in fingerprints.removed]
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO media (name, size, hash, uploaded_at) VALUES (?, ?, ?, ?)",
+                [(name, *media_manifest.entries[name]) for name in media_manifest.changed],
+            )
+            # the files of a directory listed again replace all its previous files
+            self.connection.executemany(
+                "DELETE FROM media_files WHERE dir = ?",
+                [(dir_path,) for dir_path in media_dirs_changed + media_dirs_removed],
+            )
+            self.connection.executemany(
+                "DELETE FROM media_dirs WHERE path = ?", [(dir_path,) for dir_path in media_dirs_removed]
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO media_dirs (path, mtime_ns, subdirs) VALUES (?, ?, ?)",
+                [
+                    (dir_path, media_index.dirs[dir_path]["mtime_ns"], json.dumps(media_index.dirs[dir_path]["dirs"]))
+                    for dir_path in media_dirs_changed
+                ],
+            )
+            self.connection.executemany(
+                "INSERT INTO media_files (dir, name, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                [
+                    (dir_path, name, size, mtime_ns)
+                    for dir_path in media_dirs_changed
+                    for name, (size, mtime_ns) in media_index.dirs[dir_path]["files"].items()
+                ],
+            )
+        logger.debug(
+            f"saved the state of {len(manifest.changed)} files, {len(fingerprints.changed)} notes "
+            f"and {len(media_manifest.changed)} medias, removed {len(manifest.removed)} files "
+            f"and {len(fingerprints.removed)} notes, saved {len(media_dirs_changed)} and removed "
+            f"{len(media_dirs_removed)} directories of the media index"
+        )
+        if manifest.entries:
+            manifest.legacy_hashes = set()
+        manifest.changed.clear()
+        manifest.removed.clear()
+        fingerprints.changed.clear()
+        fingerprints.removed.clear()
+        media_manifest.changed.clear()
+        if media_index is not None:
+            media_index.changed.clear()
+            media_index.removed.clear()
+
+    def close(self) -> None:
+        self.connection.close()
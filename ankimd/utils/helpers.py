@@ -2,7 +2,6 @@ import argparse
 import base64
 import fnmatch
 import hashlib
-import json
 import logging
 import os
 import re
@@ -11,6 +10,11 @@ import tempfile
 from pathlib import Path
 from typing import List
 
+try:
+    from re import _parser as sre_parse  # python >= 3.11
+except ImportError:
+    import sre_parse
+
 from ankimd.utils.constants import SUPPORTED_TEXT_EXTS
 from ankimd.utils.patterns import DELETE_REGEXES
 
@@ -79,6 +83,30 @@ def get_files_paths(
     return all_files
 
 
+def is_scanned_file(
+    file_path, dir_path, exclude_dirs=None, exclude_dotted_dirs=True, patterns_to_exclude=None
+) -> bool:
+    """whether get_files_paths would return the file, without walking the directory"""
+    file_path = Path(file_path)
+    if not any(file_path.name.endswith(extension) for extension in SUPPORTED_TEXT_EXTS):
+        return False
+    if any(fnmatch.fnmatch(file_path.name, pattern) for pattern in patterns_to_exclude or []):
+        return False
+    return is_scanned_dir(file_path.parent, dir_path, exclude_dirs, exclude_dotted_dirs)
+
+
+def is_scanned_dir(path, dir_path, exclude_dirs=None, exclude_dotted_dirs=True) -> bool:
+    """whether get_files_paths would walk into the directory"""
+    try:
+        dirs = Path(path).relative_to(dir_path).parts
+    except ValueError:
+        return False
+    for d in dirs:
+        if d in (exclude_dirs or []) or (exclude_dotted_dirs and d.startswith(".")):
+            return False
+    return True
+
+
 def erase_note_ids_in_the_files(file_paths: List[Path]):
     """Erase the note IDs from the files."""
     for file_path in file_paths:
@@ -103,37 +131,70 @@ def compute_hash(file_content: bytes) -> str:
     return hashlib.sha256(file_content).hexdigest()
 
 
-def clear_file_hashes(hashes_cache_dir):
-    try:
-        logger.info("Clearing file hashes")
-        # Ensure the parent directory exists
-        hashes_cache_dir = Path(hashes_cache_dir)
-        hashes_cache_dir.parent.mkdir(parents=True, exist_ok=True)
-        with open(hashes_cache_dir, "w") as f:
-            f.write("[]")
-    except FileNotFoundError:
-        return
+def file_hash(filepath, block_size: int = 1024 * 1024) -> str:
+    """sha256 of the file, read in blocks so big medias are never fully loaded in memory"""
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
 
+def get_required_literals(regex: str, flags: int = 0) -> List[str]:
+    """
+    Get the literal strings that every match of the regex has to contain.
 
-def open_cache(hashes_path: Path):
+    Only the parts of the regex that are mandatory are considered, that is, literals inside
+    alternations, optional groups, negative lookarounds and case insensitive parts are ignored.
+    If a text does not contain all of the returned literals, the regex cannot match it.
+    If the regex cannot be analyzed, no literals are returned, so nothing is ever skipped.
+    """
     try:
-        logger.info(f"Opening cache file at {hashes_path}")
-        # Ensure the parent directory exists
-        hashes_path.parent.mkdir(parents=True, exist_ok=True)
-        
-        with open(hashes_path, "r") as f:
-            cache = json.loads(f.read())
-        return cache
-    except FileNotFoundError:
-        # Create the directory and return empty cache
-        hashes_path.parent.mkdir(parents=True, exist_ok=True)
+        parsed = sre_parse.parse(regex, flags)
+    except Exception:
         return []
+    literals = []
+    ignore_case = bool(parsed.state.flags & re.IGNORECASE)
+    _collect_required_literals(parsed, literals, ignore_case)
+    return sorted(set(literals), key=len, reverse=True)
+
+
+def _collect_required_literals(parsed, literals: List[str], ignore_case: bool) -> None:
+    run = []
+    for op, av in parsed:
+        if op is sre_parse.LITERAL and not ignore_case:
+            run.append(chr(av))
+            continue
+        if run:
+            literals.append("".join(run))
+            run = []
+        if op is sre_parse.SUBPATTERN:
+            _, add_flags, del_flags, sub_pattern = av
+            sub_ignore_case = (ignore_case or bool(add_flags & re.IGNORECASE)) and not (
+                del_flags & re.IGNORECASE
+            )
+            _collect_required_literals(sub_pattern, literals, sub_ignore_case)
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            min_repeat, _, sub_pattern = av
+            if min_repeat >= 1:
+                _collect_required_literals(sub_pattern, literals, ignore_case)
+        elif op is sre_parse.ASSERT:
+            _, sub_pattern = av
+            _collect_required_literals(sub_pattern, literals, ignore_case)
+    if run:
+        literals.append("".join(run))
 
 
 def setup_cli_parser():
     """Set up the command-line argument parser."""
     parser = argparse.ArgumentParser()
-    # Positional argument
+    # Positional arguments
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=["watch"],
+        help="watch: keep running and sync the vault whenever a file changes",
+    )
     parser.add_argument(
         "config_path",
         metavar="config_path",
@@ -152,17 +213,41 @@ def setup_cli_parser():
         action="store_true",
         help="activates the debug log file",
     )
+    parser.add_argument(
+        "--io-workers",
+        type=int,
+        default=1,
+        help="number of threads used to stat, read and hash the vault files",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="number of processes used to scan the changed files and transform the fields of their notes",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=0.2,
+        help="in watch mode, seconds without changes to wait for before syncing a burst of writes",
+    )
+    parser.add_argument(
+        "--poll",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="in watch mode, poll the vault every SECONDS instead of using inotify",
+    )
+    parser.add_argument(
+        "--overlap",
+        action="store_true",
+        help="run the independent stages of the sync, like uploading media and updating notes, at the same time",
+    )
     args = parser.parse_args()
     return args
 
 
-def write_hashes_to_file(curr_hashes, hashes_path: Path):
-    # Ensure the parent directory exists before writing
-    hashes_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(hashes_path, "w") as f:
-        f.write(json.dumps(curr_hashes))
-
-
 def setup_root_logger(debug=False):
     root_logger = logging.getLogger("")
     root_logger.setLevel(logging.DEBUG)
@@ -34,6 +34,9 @@ OBS_INLINE_MATH_REGEX = re.compile(OBS_INLINE_MATH_PATTERN)
 OBS_DISPLAY_MATH_PATTERN = "\$\$([\s\S]*?)\$\$"
 OBS_DISPLAY_MATH_REGEX = re.compile(OBS_DISPLAY_MATH_PATTERN)
 
+HEADING_PATTERN = r"^(#{1,6})\s+(.*)"  # markdown headings (ATX style), the number of # is the level
+HEADING_REGEX = re.compile(HEADING_PATTERN, re.MULTILINE)
+
 ID_REGEX_PATTERN = r"\n*(?P<id_str><!--ID: (?P<id_num>\d+)-->)?"  # this regex will be appended to the main regex to check for the id and delete tag, they will be optional
 
 DELETE_AFTER_REGEX_PATTERN = r"\n?(?P<id_str><!--ID: (?P<id_num>\d+)--> *(?P<delete>DELETE))\b"  # this regex will match the id and the delete tag, they are required in order to match
@@ -42,3 +45,7 @@ DELETE_REGEXES = [
     re.compile(DELETE_AFTER_REGEX_PATTERN),
     re.compile(DELETE_ABOVE_REGEX_PATTERN),
 ]  # this is a list of regexes that will be used to find notes to delete
+DELETE_REQUIRED_LITERALS = [
+    "DELETE",
+    "<!--ID: ",
+]  # every match of the DELETE_REGEXES contains these, so files without them are not scanned for notes to delete
@@ -1,8 +1,13 @@
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
 from ankimd.files import File
-from ankimd.notes.note import NoteType
+from ankimd.manifest import FileManifest, FileStat
+from ankimd.notes.note import NoteRecord, NoteType
+from ankimd.notes.render_cache import RenderCache, get_render_cache, set_render_cache
 from ankimd.notes.manager import NotesManager
 from ankimd.utils.helpers import get_files_paths
 
@@ -10,6 +15,32 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# note types of the worker process, set once by the initializer of the process pool
+_worker_note_types: Optional[List[NoteType]] = None
+
+
+def _init_scan_worker(note_types: List[NoteType], render_cache_path: Optional[Path]) -> None:
+    global _worker_note_types
+    _worker_note_types = note_types
+    # the workers only read the render cache, the fields they render are written by the main process
+    if render_cache_path is None:
+        set_render_cache(None)
+    else:
+        set_render_cache(RenderCache(render_cache_path, max_bytes=0, readonly=True))
+
+
+def _scan_file_worker(file_path, vault_path, vault_name, content) -> Tuple[List[NoteRecord], Dict[str, str]]:
+    """
+    scans the file and transforms the fields of its notes in a worker process,
+    returns the notes found and the fields that were not in the render cache
+    """
+    file = File(file_path, vault_path=vault_path, vault_name=vault_name, content=content)
+    notes = file.scan_file(note_types=_worker_note_types)
+    records = [NoteRecord(note, _worker_note_types) for note in notes]
+    render_cache = get_render_cache()
+    rendered_fields = render_cache.take_pending() if render_cache is not None else {}
+    return records, rendered_fields
+
 
 class VaultManager:
     """
@@ -25,6 +56,8 @@ class VaultManager:
     exclude_dirs: list[str]
     exclude_dotted_dirs: bool
     note_types: list[NoteType]
+    io_workers: int
+    jobs: int
 
     def __init__(
         self,
@@ -33,43 +66,124 @@ class VaultManager:
         exclude_dotted_dirs=True,
         patterns_to_exclude=None,
         note_types=None,
+        io_workers=1,
+        jobs=1,
+        file_paths=None,
     ):
         self.vault_path = vault_path
+        self.io_workers = io_workers
+        self.jobs = jobs
         self.vault_path_abs = os.path.abspath(vault_path)
         self.vault_name = os.path.basename(self.vault_path_abs)
         logger.info(f"Vault name: {self.vault_name}")
-        self.file_paths = get_files_paths(
-            self.vault_path,
-            exclude_dirs=exclude_dirs,
-            exclude_dotted_dirs=exclude_dotted_dirs,
-            patterns_to_exclude=patterns_to_exclude,
-        )
+        # the files can be given when they are already known, like in watch mode
+        if file_paths is None:
+            file_paths = get_files_paths(
+                self.vault_path,
+                exclude_dirs=exclude_dirs,
+                exclude_dotted_dirs=exclude_dotted_dirs,
+                patterns_to_exclude=patterns_to_exclude,
+            )
+        self.file_paths = file_paths
         logger.debug(f"Files found: {self.file_paths}")
-        self.set_files()
+        self.files = []
+        self.new_files = []
         self.note_types = note_types
 
-    def set_new_files(self, file_hashes):
-        self.new_files = [
-            file for file in self.files if file.original_hash not in file_hashes
+    def set_new_files(self, manifest: FileManifest, candidate_paths=None):
+        """
+        only the files whose stat changed since the last run are opened and hashed,
+        and only the ones whose hash changed as well are considered new.
+        When the files that may have changed are known, only candidate_paths are looked at
+        """
+        if candidate_paths is None:
+            candidate_paths = self.file_paths
+        stats = self._map(FileStat.from_path, candidate_paths)
+        changed_paths = [
+            file_path
+            for file_path, stat in zip(candidate_paths, stats, strict=True)
+            if not manifest.is_unchanged(os.path.relpath(file_path, self.vault_path), stat)
         ]
+        logger.info(
+            f"{len(changed_paths)} of {len(candidate_paths)} files changed on disk since the last run"
+        )
 
-    def set_files(self):
-        self.files = [
-            File(file_path, vault_path=self.vault_path, vault_name=self.vault_name) for file_path in self.file_paths
+        self.set_files(changed_paths)
+        self.new_files = [
+            file
+            for file in self.files
+            if not manifest.has_hash(file.relative_path, file.original_hash)
         ]
 
+    def set_files(self, file_paths):
+        self.files = self._map(self._read_file, file_paths)
+
+    def _read_file(self, file_path) -> File:
+        return File(file_path, vault_path=self.vault_path, vault_name=self.vault_name)
+
+    def _map(self, func, items) -> list:
+        """
+        applies func to every item, keeping the order of the items.
+        With more than one io worker the calls run on a thread pool, which pays off because
+        stat, reading and hashing the files release the GIL
+        """
+        if self.io_workers <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=self.io_workers) as executor:
+            return list(executor.map(func, items))
+
     def get_notes_from_new_files(self) -> NotesManager:
         """Scan all the new files found in vault."""
 
+        if self.jobs > 1 and len(self.new_files) > 1:
+            return self._get_notes_from_new_files_in_processes()
+
         notes = []
         for file in self.new_files:
             curr_notes = file.scan_file(note_types=self.note_types)
             notes.extend(curr_notes)
         return NotesManager(notes)
 
-    def get_curr_file_hashes(self):
-        return [file.curr_hash for file in self.files]
-    
+    def _get_notes_from_new_files_in_processes(self) -> NotesManager:
+        """
+        the regex matching and the transformation of the fields are cpu bound, so with more than one job
+        they run on a pool of processes, which send back NoteRecords that are turned into notes again here
+        """
+        logger.info(f"Scanning {len(self.new_files)} files with {self.jobs} processes")
+        notes = []
+        render_cache = get_render_cache()
+        render_cache_path = render_cache.path if render_cache is not None else None
+        # the stages of the sync may run in threads, and forking a process with threads running can deadlock it
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        with ProcessPoolExecutor(
+            max_workers=self.jobs,
+            mp_context=multiprocessing.get_context(start_method),
+            initializer=_init_scan_worker,
+            initargs=(self.note_types, render_cache_path),
+        ) as executor:
+            results = executor.map(
+                _scan_file_worker,
+                [file.path for file in self.new_files],
+                [self.vault_path] * len(self.new_files),
+                [self.vault_name] * len(self.new_files),
+                [file.curr_file_content for file in self.new_files],
+            )
+            for file, (records, rendered_fields) in zip(self.new_files, results, strict=True):
+                notes.extend(file.set_found_notes_from_records(records, self.note_types))
+                for key, value in rendered_fields.items():
+                    render_cache.put(key, value)
+        return NotesManager(notes)
+
+    def update_manifest(self, manifest: FileManifest) -> None:
+        """records the files read in this run and forgets the ones that were removed from the vault"""
+        manifest.retain(
+            os.path.relpath(file_path, self.vault_path) for file_path in self.file_paths
+        )
+        for file in self.files:
+            manifest.set(file.relative_path, file.stat, file.curr_hash)
+
     def write_updated_content_to_files(self):
         for file in self.new_files:
-            file.update_content()
+            file.recompute_hash()
+            if file.curr_hash != file.original_hash:
+                file.update_content()
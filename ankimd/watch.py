@@ -0,0 +1,244 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from ankimd.config_parser import NewConfig
+from ankimd.run import SyncRun
+
+logger = logging.getLogger(__name__)
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """
+    reports the paths changed under the roots, using inotify through ctypes, so no dependency is needed.
+
+    Every directory is watched, except the excluded ones, and the directories created later are watched as they appear.
+    read_changes returns None when the kernel dropped events, then the caller has to assume anything changed.
+    """
+
+    roots: List[Path]
+    is_excluded_dir: Callable[[str], bool]
+    watches: Dict[int, Path]
+
+    def __init__(self, roots: List[Path], is_excluded_dir: Callable[[str], bool]):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not supported on this platform")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.roots = roots
+        self.is_excluded_dir = is_excluded_dir
+        self.watches = {}
+        for root in roots:
+            self._watch_tree(root)
+
+    def _watch_tree(self, dir_path: Path) -> None:
+        for root, dirs, _ in os.walk(dir_path):
+            dirs[:] = [d for d in dirs if not self.is_excluded_dir(d)]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                logger.warning(f"could not watch {root}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self.watches[wd] = Path(root)
+
+    def read_changes(self, timeout: Optional[float]) -> Optional[Set[Path]]:
+        """waits at most timeout seconds, forever with None, for changes and returns the changed paths"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        overflow = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + name_length].rstrip(b"\0")
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            dir_path = self.watches.get(wd)
+            if dir_path is None:
+                continue
+            path = dir_path / os.fsdecode(name) if name else dir_path
+            if mask & IN_ISDIR and self.is_excluded_dir(path.name):
+                continue
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # the files written in the new directory before it was watched are reported with the directory
+                self._watch_tree(path)
+        return None if overflow else changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    reports the paths changed under the roots by comparing the stat of every file every interval seconds,
+    for the platforms without inotify and the file systems that don't report changes, like network mounts
+    """
+
+    roots: List[Path]
+    is_excluded_dir: Callable[[str], bool]
+    interval: float
+    snapshot: Dict[Path, Tuple[int, int]]
+
+    def __init__(self, roots: List[Path], is_excluded_dir: Callable[[str], bool], interval: float = 1.0):
+        self.roots = roots
+        self.is_excluded_dir = is_excluded_dir
+        self.interval = interval
+        self.snapshot = self._take_snapshot()
+
+    def _take_snapshot(self) -> Dict[Path, Tuple[int, int]]:
+        snapshot = {}
+        for dir_path in self.roots:
+            for root, dirs, files in os.walk(dir_path):
+                dirs[:] = [d for d in dirs if not self.is_excluded_dir(d)]
+                for filename in files:
+                    path = Path(root) / filename
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    snapshot[path] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def read_changes(self, timeout: Optional[float]) -> Optional[Set[Path]]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            time.sleep(self.interval if deadline is None else max(0.0, min(self.interval, deadline - time.monotonic())))
+            snapshot = self._take_snapshot()
+            changed = {
+                path
+                for path in snapshot.keys() | self.snapshot.keys()
+                if snapshot.get(path) != self.snapshot.get(path)
+            }
+            self.snapshot = snapshot
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def close(self) -> None:
+        pass
+
+
+def wait_for_changes(watcher, debounce: float) -> Optional[Set[Path]]:
+    """
+    waits for a change, then keeps collecting changes until none came for debounce seconds,
+    so a burst of writes, like an editor saving a file in several steps, is synced once
+    """
+    changed = set()
+    timeout = None
+    while True:
+        batch = watcher.read_changes(timeout)
+        if batch is None:
+            changed = None
+        elif not batch and timeout is not None:
+            return changed
+        elif changed is not None:
+            changed.update(batch)
+        if changed is None or changed:
+            timeout = debounce
+
+
+def watch(
+    config: NewConfig,
+    io_workers: int = 1,
+    jobs: int = 1,
+    overlap: bool = False,
+    debounce: float = 0.2,
+    poll_interval: Optional[float] = None,
+):
+    """
+    syncs the vault, then keeps syncing the changed files until interrupted.
+
+    The same SyncRun is reused between the syncs, so the compiled note types, the state files, the media index,
+    the names of the medias in anki and the connection to anki stay in memory, and a sync only looks at the
+    files that changed.
+    """
+    vault_config = config.vault
+    state_dir = Path(config.hashes_cache_dir).resolve()
+    exclude_dirs = set(vault_config.exclude_dirs_from_scan or [])
+
+    def is_excluded_dir(name: str) -> bool:
+        return name in exclude_dirs or (vault_config.exclude_dotted_dirs_from_scan and name.startswith("."))
+
+    roots = [Path(vault_config.dir_path)]
+    medias_dir_path = Path(vault_config.medias_dir_path)
+    if roots[0].resolve() not in [medias_dir_path.resolve(), *medias_dir_path.resolve().parents]:
+        roots.append(medias_dir_path)
+
+    # the watcher is started before the first sync, so no change made during it is missed
+    watcher = None
+    if poll_interval is None:
+        try:
+            watcher = InotifyWatcher(roots, is_excluded_dir)
+        except OSError as err:
+            logger.warning(f"inotify is not available ({err}), polling the vault every second instead")
+    if watcher is None:
+        watcher = PollingWatcher(roots, is_excluded_dir, interval=poll_interval or 1.0)
+
+    sync_run = SyncRun(config, io_workers=io_workers, jobs=jobs)
+    try:
+        sync_run.sync(overlap=overlap)
+        logger.info(f"watching {', '.join(str(root) for root in roots)} for changes")
+        full_sync = False
+        while True:
+            changed_paths = wait_for_changes(watcher, debounce)
+            if changed_paths is not None:
+                # the state files written by the sync itself are not changes of the vault
+                changed_paths = {
+                    path for path in changed_paths if state_dir not in path.resolve().parents
+                }
+                if not changed_paths:
+                    continue
+            if full_sync:
+                changed_paths = None
+            start = time.monotonic()
+            try:
+                sync_run.sync(changed_paths, overlap=overlap)
+            except Exception:
+                # the changes of the failed sync are not in the manifest, the next sync looks at the whole vault
+                logger.exception("the sync failed, waiting for the next change to try again")
+                full_sync = True
+                continue
+            full_sync = False
+            logger.info(f"synced in {time.monotonic() - start:.2f}s")
+    except KeyboardInterrupt:
+        logger.info("stopped watching")
+    finally:
+        watcher.close()
+        sync_run.close()
@@ -0,0 +1,24 @@
+from ankimd.notes.render_cache import RenderCache
+
+
+def test_readonly_cache_in_a_path_with_uri_characters(tmp_path):
+    vault_dir = tmp_path / "My Vault #1 ?50%"
+    cache_path = vault_dir / ".obsankipy" / ".My Vault #1_render_cache.sqlite3"
+    cache = RenderCache(cache_path, max_bytes=1024 * 1024)
+    key = RenderCache.make_key("Field", "some text", "My Vault #1")
+    cache.put(key, "<p>some text</p>")
+    cache.close()
+
+    readonly_cache = RenderCache(cache_path, max_bytes=1024 * 1024, readonly=True)
+    assert readonly_cache.get(key) == "<p>some text</p>"
+    readonly_cache.close()
+
+
+def test_flush_keeps_the_cache_within_max_bytes(tmp_path):
+    cache = RenderCache(tmp_path / "render_cache.sqlite3", max_bytes=100)
+    for i in range(10):
+        cache.put(f"key{i}", "x" * 30)
+        cache.flush()
+    size = cache.connection.execute("SELECT SUM(size) FROM fields").fetchone()[0]
+    assert size <= 100
+    cache.close()